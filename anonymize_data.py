@@ -1,66 +1,56 @@
+import click
 from datetime import datetime
+from functools import partial
 import os
 import pydicom
-from pydicom.datadict import tag_for_keyword
-import hashlib
+from pydicom.uid import RE_VALID_UID
 import multiprocessing as mp
+import shutil
+import struct
+import time
 import warnings
-warnings.filterwarnings("ignore")
+
+from deid_profile import CompiledProfile
+from manifest import file_entry, Manifest
+from metrics import instrument, METRICS
+from pseudonyms import pseudonym, scan_patients, PseudonymTable
+from series_store import SeriesStore, COMPRESSIONS
+from uid_map import UIDMap, UIDTable
 
 # SPECIFY DIRECTORIES
 DATADIR = "../dicom"
 SRCDIR = os.path.join(DATADIR, "extracted")
 DSTDIR = os.path.join(DATADIR, "anonymized")
+CHUNK_SIZE = 1024 * 1024  # Chunk size of raw pixel data copies (bytes)
+MANIFEST_FILE = os.path.join(DSTDIR, "manifest.sqlite")
+UID_FILE = os.path.join(DSTDIR, "uids.sqlite")
+PSEUDONYM_FILE = os.path.join(DATADIR, "pseudonyms.sqlite")
+PROFILE_VERSION = "5"     # Increase when the anonymization rules change, to process all files again
+
+# UID mapping and de-identification profile of the process, shared by all files anonymized in it
+UID_MAP = UIDMap()
+PROFILE = CompiledProfile(uid_map=UID_MAP)
 
 
 def anonymize_patient_id(patient_id):
-    # Use a hash function to create a unique anonymized patient ID
-    anonymized_id = hashlib.sha256(patient_id.encode()).hexdigest()[:10]
-    return anonymized_id
+    # Use a keyed hash function to create a unique anonymized patient ID
+    return pseudonym(patient_id)
+
+
+def anonymize_dataset(ds, anonymized_id):
+    ''' De-identify the header of a dataset in place.
+    '''
+    # Replace the patient ID and name, remove personal information and private tags, and
+    # remap UIDs consistently for all files of a study/series and all references to them
+    PROFILE.apply(ds, {'PatientID': anonymized_id, 'PatientName': "ANONYMIZED"})
+    if hasattr(ds, 'file_meta'):
+        UID_MAP.remap(ds.file_meta)
 
 
 def anonymize_dicom(dicom_file, output_file, anonymized_id):
     # Load the DICOM file
     ds = pydicom.dcmread(dicom_file)
-
-    # Remove personal information (Patient Name, Patient ID, etc.)
-    ds.PatientID = anonymized_id
-    ds.PatientName = "ANONYMIZED"
-
-    # Check for any additional private tags and remove them
-    ds.PatientBirthDate = ''
-    ds.PatientAddress = ''
-
-    # Tags to remove, based on the DICOM standard for de-identification (Table E.1-1)
-    tags_to_remove = [
-        'OtherPatientIDs', 'OtherPatientNames', 'PatientBirthDate', 'PatientBirthTime',
-        'PatientSex', 'PatientAge', 'PatientAddress', 'PatientMotherBirthName',
-        'PatientTelephoneNumbers', 'PatientInsurancePlanCodeSequence', 'PatientPrimaryLanguageCodeSequence',
-        'ResponsiblePerson', 'ResponsiblePersonRole', 'ResponsibleOrganization',
-        'IssuerOfPatientID', 'IssuerOfPatientIDQualifiersSequence', 'PatientID',
-        'AccessionNumber', 'InstitutionName', 'InstitutionAddress',
-        'InstitutionalDepartmentName', 'ReferringPhysicianName', 'ReferringPhysicianTelephoneNumbers',
-        'PhysiciansOfRecord', 'PerformingPhysicianName', 'OperatorsName',
-        'StudyDate', 'SeriesDate', 'AcquisitionDate', 'ContentDate',
-        'StudyTime', 'SeriesTime', 'AcquisitionTime', 'ContentTime',
-        'StudyID', 'StudyDescription', 'SeriesDescription', 'PhysicianOfRecord',
-        'PerformingPhysicianName', 'DeviceSerialNumber', 'InstitutionalDepartmentName',
-        'StationName', 'Manufacturer', 'ManufacturerModelName', 'SoftwareVersions',
-        'ProtocolName', 'DeviceUID', 'StationName', 'ScheduledProcedureStepDescription'
-    ]
-
-    # Remove or anonymize sensitive information
-    for tag_keyword in tags_to_remove:
-        tag = tag_for_keyword(tag_keyword)
-        if tag in ds:
-            del ds[tag]
-    ds.remove_private_tags()
-
-    # Remove UIDs
-    ds.StudyInstanceUID = ''
-    ds.SeriesInstanceUID = ''
-    ds.SOPInstanceUID = ''
-
+    anonymize_dataset(ds, anonymized_id)
 
     # Save the anonymized DICOM file
     # Save the anonymized file to the output directory
@@ -68,71 +58,198 @@ def anonymize_dicom(dicom_file, output_file, anonymized_id):
     return f"Anonymized: {dicom_file} -> {output_file}"
 
 
-def process_dicom(dicom_file, output_file, anonymized_id):
+def pixel_data_end(src, transfer_syntax):
+    ''' End offset of the PixelData element starting at the current position of a file.
+    The element is skipped by its length, or item by item if its pixel data is encapsulated.
+    Return:
+        offset after the element, None if the element is not (7FE0,0010) or is truncated
+    '''
+    endian = '<' if transfer_syntax.is_little_endian else '>'
+    header = src.read(8)
+    if len(header) < 8 or struct.unpack(endian + 'HH', header[:4]) != (0x7FE0, 0x0010):
+        return None
+    if transfer_syntax.is_implicit_VR:
+        length = struct.unpack(endian + 'L', header[4:])[0]
+    else:
+        # OB/OW have 2 reserved bytes and a 4-byte length after the VR
+        if header[4:6] not in (b'OB', b'OW'):
+            return None
+        length = struct.unpack(endian + 'L', src.read(4))[0]
+    if length != 0xFFFFFFFF:
+        src.seek(length, os.SEEK_CUR)
+        return src.tell()
+
+    # Encapsulated pixel data: items up to the sequence delimiter
+    while True:
+        item = src.read(8)
+        if len(item) < 8:
+            return None
+        group, element, length = struct.unpack(endian + 'HHL', item)
+        if (group, element) == (0xFFFE, 0xE0DD):
+            return src.tell()
+        if (group, element) != (0xFFFE, 0xE000):
+            return None
+        src.seek(length, os.SEEK_CUR)
+
+
+def anonymize_dicom_header(dicom_file, output_file, anonymized_id):
+    ''' Anonymize a DICOM file without loading its pixel data.
+    Only the header up to the pixel data is read and de-identified, and the
+    PixelData element is copied as raw bytes from the source file, so the
+    memory use stays near the header size. Files with elements after the
+    pixel data, which would not be de-identified, and deflated files, whose
+    pixel data cannot be located, are anonymized in full.
+    '''
+    with open(dicom_file, 'rb') as src:
+        ds = pydicom.dcmread(src, stop_before_pixels=True)
+        offset = src.tell()
+
+        # Check that the header stopped at the pixel data, and that nothing follows it
+        transfer_syntax = ds.file_meta.get('TransferSyntaxUID') if hasattr(ds, 'file_meta') else None
+        if transfer_syntax is None or transfer_syntax.is_deflated:
+            return anonymize_dicom(dicom_file, output_file, anonymized_id)
+        size = os.fstat(src.fileno()).st_size
+        end = pixel_data_end(src, transfer_syntax) if offset < size else offset
+        if end != size:
+            return anonymize_dicom(dicom_file, output_file, anonymized_id)
+
+        anonymize_dataset(ds, anonymized_id)
+        with open(output_file, 'wb') as dst:
+            ds.save_as(dst)
+            src.seek(offset)
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    return f"Anonymized: {dicom_file} -> {output_file}"
+
+
+def process_dicom(dicom_file, output_file, anonymized_id, fast=True):
+    if fast:
+        return anonymize_dicom_header(dicom_file, output_file, anonymized_id)
     return anonymize_dicom(dicom_file, output_file, anonymized_id)
 
 
-def anonymize_dicom_files(patient_folder, anonymized_id):
-    ''' Iterate over patient folder and anonymize all dicom files.
+def list_dicom_files(patient_folder, anonymized_id):
+    ''' List the dicom files of a patient folder together with their output paths.
+    The output paths are <pseudonym>/<new StudyUID>/<new SeriesUID>/, as written by
+    receive_data.py --anonymize, with the UIDs of the first file of each series folder.
+    Files named after a UID, e.g. their SOP instance UID, are named after the new UID.
     Args:
         patient_folder: Folder with 10-digit patient ID as prefix
         anonymized_id: 10-digit hash
     Return:
-        None
+        list of (dicom file, output file, anonymized ID)
     '''
+    tasks = []
     patient_path = os.path.join(SRCDIR, patient_folder)
 
-    # Iterate through study folders
-    for study_folder in os.listdir(patient_path):
-        study_path = os.path.join(patient_path, study_folder)
-
-        # Iterate through series folders
-        for series_folder in os.listdir(study_path):
-            series_path = os.path.join(study_path, series_folder)
-
-            # Iterate through DICOM files
-            for dicom_file in os.listdir(series_path):
-                dicom_file_path = os.path.join(series_path, dicom_file)
-
-                # Ensure it's a file and ends with ".dcm"
-                if os.path.isfile(dicom_file_path) and dicom_file.endswith(".dcm"):
-
-                    # Create corresponding output directories (with anonymized patient ID)
-                    output_patient_folder = os.path.join(DSTDIR, anonymized_id)
-                    output_study_folder = os.path.join(output_patient_folder, study_folder)
-                    output_series_folder = os.path.join(output_study_folder, series_folder)
-                    os.makedirs(output_series_folder, exist_ok=True)
-
-                    # Output file path
-                    output_file_path = os.path.join(output_series_folder, dicom_file)
-
-                    # Anonymize dicom file
-                    process_dicom(dicom_file_path, output_file_path, anonymized_id)
-
-
-def main():
-    patient_lookup = {}
-
-    # 1) Create a lookup table
-    for i, patient_folder in enumerate(os.listdir(SRCDIR)):
-        PatientID = patient_folder[:10]
-
-        print(f'Processing {i} - {PatientID}')
-        print('-'*20)
-        print()
+    # Iterate through study and series folders
+    for study in os.scandir(patient_path):
+        for series in os.scandir(study.path):
+            dicom_files = [entry for entry in os.scandir(series.path) if entry.name.endswith(".dcm") and entry.is_file()]
+            if not dicom_files:
+                continue
+
+            # Corresponding output directory (with anonymized patient ID and UIDs), the source
+            # folder names are not reused as they may be the original UIDs
+            ds = pydicom.dcmread(dicom_files[0].path, stop_before_pixels=True,
+                                 specific_tags=['StudyInstanceUID', 'SeriesInstanceUID'])
+            output_series_folder = os.path.join(DSTDIR, anonymized_id, UID_MAP.map(str(ds.StudyInstanceUID)),
+                                                UID_MAP.map(str(ds.SeriesInstanceUID)))
+            for dicom_file in dicom_files:
+                stem = dicom_file.name[:-len(".dcm")]
+                name = f"{UID_MAP.map(stem)}.dcm" if '.' in stem and RE_VALID_UID.match(stem) else dicom_file.name
+                tasks.append((dicom_file.path, os.path.join(output_series_folder, name), anonymized_id))
+    return tasks
+
+
+def process_task(task, fast=True):
+    ''' Anonymize a dicom file and return its manifest entry, the UID mappings created for it
+    and the time its anonymization took.
+    '''
+    start = time.perf_counter()
+    process_dicom(*task, fast=fast)
+    seconds = time.perf_counter() - start
+    return file_entry(task[0], task[1]), UID_MAP.drain(), seconds
 
-        anonymized_id = anonymize_patient_id(PatientID)
-        patient_lookup[PatientID] = anonymized_id
-        print(PatientID, anonymized_id)
-    anonymized_ids = list(patient_lookup.values())
 
-    # 2) Anonymize files using multiprocessing
-    patient_folders = os.listdir(SRCDIR)
-    with mp.Pool(mp.cpu_count()) as pool:
-        _ = pool.starmap(anonymize_dicom_files, zip(patient_folders, anonymized_ids))
+def anonymize_dicom_files(patient_folder, anonymized_id):
+    ''' Iterate over patient folder and anonymize all dicom files.
+    Args:
+        patient_folder: Folder with 10-digit patient ID as prefix
+        anonymized_id: 10-digit hash
+    Return:
+        None
+    '''
+    tasks = list_dicom_files(patient_folder, anonymized_id)
+    for folder in set(os.path.dirname(task[1]) for task in tasks):
+        os.makedirs(folder, exist_ok=True)
+    for task in tasks:
+        METRICS.observe('anonymize_file_seconds', process_task(task)[2])
+
+
+@click.command()
+@click.option('--workers', default=mp.cpu_count(), type=int, help='The number of worker processes.')
+@click.option('--chunksize', default=16, type=int, help='The number of files handed to a worker at once.')
+@click.option('--fast/--full', default=True, help='Whether to copy the pixel data as raw bytes instead of decoding the whole file.')
+@click.option('--incremental/--all', default=True, help='Whether to skip files that are unchanged since the last run.')
+@click.option('--pack', default='', type=click.Choice([''] + COMPRESSIONS), help='Pack the anonymized series into one zip file each, with this compression (not packed if empty).')
+@instrument('anonymize_data')
+def main(workers, chunksize, fast, incremental, pack):
+    # Silence the pydicom warnings of non-conformant headers, in this command and its worker processes only,
+    # so that importing this module (e.g. for receive_data.py) keeps the warnings of the importing script
+    warnings.filterwarnings("ignore")
+
+    # 1) Create a lookup table, pairing folders and IDs from a single directory scan
+    patients = scan_patients(SRCDIR)
+    with PseudonymTable(PSEUDONYM_FILE) as table:
+        patient_lookup = table.register(PatientID for _, PatientID in patients)
+    print(f'{len(patient_lookup)} patients registered')
+
+    # 2) List all files up front and create each output directory once
+    tasks = []
+    for patient_folder, PatientID in patients:
+        tasks += list_dicom_files(patient_folder, patient_lookup[PatientID])
+    print(f'{len(tasks)} files in {len(patients)} patient folders')
+
+    # Skip the files that were already anonymized with the current profile
+    manifest = Manifest(MANIFEST_FILE, PROFILE_VERSION)
+    store = SeriesStore(DSTDIR, pack) if pack else None
+    if incremental:
+        n_files = len(tasks)
+        packed = store.members() if store is not None else set()
+        tasks = manifest.pending(tasks, exists=lambda path: path in packed or os.path.exists(path))
+        print(f'{n_files - len(tasks)} files unchanged, {len(tasks)} files to anonymize')
+    for folder in set(os.path.dirname(task[1]) for task in tasks):
+        os.makedirs(folder, exist_ok=True)
+
+    # 3) Anonymize files using multiprocessing, spreading chunks of files over all workers
+    # Processed files are recorded in the manifest in batches, so that an interrupted run can resume.
+    # The UID mappings of all workers are collected in one table
+    start = datetime.now()
+    entries = []
+    # Including the mappings of the output paths
+    mappings = UID_MAP.drain()
+    with mp.Pool(workers) as pool, manifest, UIDTable(UID_FILE) as uid_table:
+        for i, (entry, new_uids, seconds) in enumerate(pool.imap_unordered(partial(process_task, fast=fast), tasks, chunksize=chunksize), 1):
+            # The files are timed in the workers and recorded here
+            METRICS.observe('anonymize_file_seconds', seconds)
+            METRICS.count('anonymize_bytes_total', entry[1])
+            entries.append(entry)
+            mappings += new_uids
+            if i % 1000 == 0 or i == len(tasks):
+                uid_table.record(mappings)
+                manifest.record(entries)
+                entries = []
+                mappings = []
+                seconds = (datetime.now() - start).total_seconds()
+                print(f'{i}/{len(tasks)} files, {i / seconds:.1f} files/s')
+
+    # 4) Pack the series with loose anonymized files, including those of an interrupted run
+    if store is not None:
+        with store:
+            store.pack(workers=workers)
 
 
 if __name__ == "__main__":
     start = datetime.now()
-    main()
+    main(standalone_mode=False)
     print(f'Running time: {datetime.now() - start}')
@@ -0,0 +1,148 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+from metrics import METRICS
+from utils import move_data, extract_series
+
+
+async def run_offloaded(limit, func, *args, timeout=None, interrupt=None, on_cancel=None):
+    ''' Run a blocking function in a worker thread while holding a slot of limit.
+    A thread cannot be cancelled, so a call that times out or is cancelled
+    calls interrupt to make the function return early, e.g. by aborting its
+    association, and returns at once. The slot is kept until the thread
+    returns, and the late result is passed to on_cancel, e.g. to remove a
+    downloaded file.
+    Args:
+        limit: (asyncio.Semaphore, ThreadPoolExecutor) of the resource used by the function
+        timeout: time limit of the call once it holds its slot (s), none if None
+        interrupt: function called from the event loop when the call times out or is cancelled
+    Return:
+        result of the function, asyncio.TimeoutError is raised if it timed out
+    '''
+    semaphore, executor = limit
+    await semaphore.acquire()
+    abandoned = False
+
+    def finished(task):
+        semaphore.release()
+        if abandoned and on_cancel is not None and not task.cancelled() and task.exception() is None:
+            on_cancel(task.result())
+
+    task = asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    task.add_done_callback(finished)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        abandoned = True
+        if interrupt is not None:
+            interrupt()
+        raise
+
+
+def remove_file(path):
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+
+async def transfer_series(patientID, SerInsUID, studyDate, fname, client, limits, timeout=None):
+    ''' Download a series from the archive of the AEM and unzip it into OUT_DIR.
+    The download is stopped after `timeout` seconds, the extraction is not limited.
+    Return:
+        target directory, None if the download failed or timed out
+    '''
+    stop = threading.Event()
+    try:
+        tmp_file = await run_offloaded(limits['archive'], client.download, fname, stop, timeout, timeout=timeout,
+                                       interrupt=stop.set, on_cancel=remove_file)
+    except asyncio.TimeoutError:
+        print(f'Download of {SerInsUID} timed out after {timeout} s')
+        METRICS.count('series_timeouts_total', stage='transfer')
+        return None
+    if tmp_file is None:
+        return None
+    # A cancelled extraction still completes in its thread, which removes the downloaded file
+    return await run_offloaded(limits['disk'], extract_series, tmp_file, patientID, SerInsUID, studyDate)
+
+
+async def retrieve_study(study, pool, client, aem, get, limits, timeout=None, local=False, incomplete=None):
+    ''' Move the series of a study from the PACS and transfer each series from the archive.
+    The move is aborted after `timeout` seconds per series, each download after `timeout` seconds.
+    Args:
+        local: whether the series are written to OUT_DIR by the move itself (C-GET, or the receiver of receive_data.py as aem)
+        incomplete: list the studies whose move failed for some instances are appended to
+    Return:
+        list of retrieved series (target directories, or series instance UIDs if local)
+    '''
+    patientID, studyDate, StuInsUID, series = study
+    SerInsUIDs = [res.get('SeriesInstanceUID') for res in series]
+
+    stop = threading.Event()
+    sessions = []
+
+    def move():
+        with pool.session() as session:
+            sessions.append(session)
+            return move_data(StuInsUID, SerInsUIDs, AEM=None if get else aem, session=session, stop=stop)
+
+    def interrupt():
+        # Abort the association of the move, which is then not retried
+        stop.set()
+        for session in sessions:
+            session.abort()
+
+    print(f"Transfering {', '.join(res.get('SeriesDescription', 'N/A') for res in series)} ({patientID:010d}/{studyDate})")
+    try:
+        result = await run_offloaded(limits['pacs'], move, timeout=timeout and timeout * len(series), interrupt=interrupt)
+    except asyncio.TimeoutError:
+        print(f'Move timed out ({patientID:010d}/{studyDate})')
+        METRICS.count('series_timeouts_total', len(series), stage='move')
+        return []
+    if result is None or result['status'] not in (0x0000, 0xB000):
+        print(f'Move failed ({patientID:010d}/{studyDate})')
+        return []
+    if result['failed'] or result['status'] == 0xB000:
+        # The instances that were moved are still transferred, the others on the next run
+        print(f"Move incomplete, {result['failed']} instances failed ({patientID:010d}/{studyDate})")
+        if incomplete is not None:
+            incomplete.append(study[:3])
+    if get or local:
+        return SerInsUIDs
+
+    fnames = await run_offloaded(limits['archive'], client.find_series, SerInsUIDs, patientID)
+    transfers = []
+    for SerInsUID in SerInsUIDs:
+        if SerInsUID not in fnames:
+            print(f'{SerInsUID} not found in the archive')
+            continue
+        transfers.append(transfer_series(patientID, SerInsUID, studyDate, fnames[SerInsUID], client, limits, timeout))
+    return [target_dir for target_dir in await asyncio.gather(*transfers) if target_dir is not None]
+
+
+async def retrieve_plan(plan, pool, client, aem, get=False, move_workers=1, download_workers=2, extract_workers=1,
+                        timeout=None, local=False, incomplete=None):
+    ''' Retrieve all studies of a move plan on a single event loop.
+    All studies are in flight at once and wait for the semaphores of the
+    resources they use: the PACS associations, the archive connections and
+    the disk writers. The blocking DICOM, HTTP and disk operations run in
+    worker threads.
+    Return:
+        list of retrieved series
+    '''
+    # One thread per slot, so that no operation waits for a thread. The threads are not those of the
+    # default executor, which asyncio.run waits for, so that interrupted calls do not delay the return
+    slots = {'pacs': min(move_workers, len(pool.sessions)), 'archive': download_workers, 'disk': extract_workers}
+    limits = {resource: (asyncio.Semaphore(n), ThreadPoolExecutor(n)) for resource, n in slots.items()}
+
+    async def retrieve(study):
+        try:
+            return await retrieve_study(study, pool, client, aem, get, limits, timeout, local, incomplete)
+        except Exception as e:
+            print(f'Retrieve failed for {study[:3]}: {e!r}')
+            return []
+
+    results = await asyncio.gather(*(retrieve(study) for study in plan))
+    for _, executor in limits.values():
+        executor.shutdown(wait=False)
+    return [output for outputs in results for output in outputs]
@@ -0,0 +1,448 @@
+import click
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import (
+    MRImageStorage,
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelMove,
+)
+
+import anonymize_data
+import find_studies
+from metrics import METRICS
+import retrieve_data
+import utils
+from utils import get_session, ArchiveClient, PACSSessionPool
+
+# Parameters
+HOST = '127.0.0.1'
+PACS_PORT = 11112      # Port of the stand-in PACS
+STORE_PORT = 11113     # Port of the C-MOVE destination
+ARCHIVE_PORT = 18042   # Port of the stand-in archive REST API
+AE_TITLE = 'BENCH'
+STORE_AE_TITLE = 'BENCHSTORE'
+START_DATE = '20240301'
+SERIES = ['t1_mprage_sag_p2', 'ep2d_diff_DTI_mddw_30_p2_AP_SMS', 'localizer']
+
+
+"""
+    Synthetic corpus
+"""
+def make_corpus(n_patients, n_series, n_instances, start=START_DATE):
+    ''' One MR brain study per patient and day, going backward from the start date.
+    Return:
+        list of series identifiers
+    '''
+    corpus = []
+    for i in range(n_patients):
+        date = (datetime.strptime(start, '%Y%m%d') - timedelta(days=i)).strftime('%Y%m%d')
+        for j in range(n_series):
+            ds = Dataset()
+            ds.PatientID = f'{1000 + i:010d}'
+            ds.PatientName = f'PATIENT^{i}'
+            ds.PatientBirthDate = '19700101'
+            ds.StudyDate = date
+            ds.StudyDescription = 'MR BRAIN'
+            ds.AccessionNumber = str(i)
+            ds.Modality = 'MR'
+            ds.BodyPartExamined = 'BRAIN'
+            ds.StudyInstanceUID = f'1.2.826.0.1.3680043.10.1.{i}'
+            ds.SeriesInstanceUID = f'1.2.826.0.1.3680043.10.1.{i}.{j}'
+            ds.SeriesDescription = SERIES[j % len(SERIES)]
+            ds.NumberOfSeriesRelatedInstances = n_instances
+            corpus.append(ds)
+    return corpus
+
+
+def make_instance(series, n, pixels):
+    ''' MR image n of a series of the corpus, with the given pixel data.
+    '''
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = MRImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = f'{series.SeriesInstanceUID}.{n}'
+    for keyword in ['PatientID', 'PatientName', 'PatientBirthDate', 'StudyDate', 'StudyDescription', 'AccessionNumber',
+                    'Modality', 'BodyPartExamined', 'StudyInstanceUID', 'SeriesInstanceUID', 'SeriesDescription']:
+        setattr(ds, keyword, series.get(keyword))
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = f'{series.SeriesInstanceUID}.{n}'
+    ds.InstanceNumber = n
+    ds.Rows = ds.Columns = int(np.sqrt(len(pixels) // 2))
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelData = pixels
+    return ds
+
+
+def matches(query, series):
+    ''' Whether a series of the corpus matches the keys of a C-FIND query (single values and date ranges).
+    '''
+    for elem in query:
+        value = str(elem.value or '')
+        if elem.VR == 'SQ' or not value or elem.keyword == 'QueryRetrieveLevel' or elem.keyword not in series:
+            continue
+        if elem.keyword == 'StudyDate' and '-' in value:
+            start, end = value.split('-')
+            if not (start or '0') <= series.StudyDate <= (end or '9'):
+                return False
+        elif elem.VR == 'UI':
+            uids = [str(uid) for uid in elem.value] if elem.VM > 1 else value.split('\\')
+            if str(series.get(elem.keyword)) not in uids:
+                return False
+        elif '*' not in value and '?' not in value and str(series.get(elem.keyword)) != value:
+            return False
+    return True
+
+
+"""
+    Stand-ins
+"""
+class StandInPACS:
+    ''' pynetdicom SCP serving C-FIND, C-MOVE and C-GET of a synthetic corpus.
+    Args:
+        corpus: list of series identifiers
+        pixels: pixel data of every instance
+        latency: delay of every request (s)
+        destinations: dict of AE title to (address, port) of the C-MOVE destinations
+    '''
+    def __init__(self, corpus, pixels, latency=0., port=PACS_PORT, destinations=None):
+        self.corpus = corpus
+        self.pixels = pixels
+        self.latency = latency
+        self.destinations = destinations or {}
+        self.n_queries = 0
+        self.n_responses = 0
+        self._lock = threading.Lock()
+
+        self.ae = AE('GEPACS')
+        self.ae.maximum_associations = 20
+        for context in [StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelMove,
+                        StudyRootQueryRetrieveInformationModelGet]:
+            self.ae.add_supported_context(context)
+        self.ae.add_supported_context(MRImageStorage, scu_role=True, scp_role=True)
+        self.ae.add_requested_context(MRImageStorage)
+        handlers = [(evt.EVT_C_FIND, self.find), (evt.EVT_C_MOVE, self.move), (evt.EVT_C_GET, self.get)]
+        self.server = self.ae.start_server((HOST, port), block=False, evt_handlers=handlers)
+
+    def stop(self):
+        self.server.shutdown()
+
+    def find(self, event):
+        query = event.identifier
+        time.sleep(self.latency)
+        with self._lock:
+            self.n_queries += 1
+        for series in self.corpus:
+            if not matches(query, series):
+                continue
+            identifier = Dataset()
+            for elem in query:
+                if elem.keyword in series:
+                    setattr(identifier, elem.keyword, series.get(elem.keyword))
+                else:
+                    identifier.add(elem)
+            identifier.QueryRetrieveLevel = query.QueryRetrieveLevel
+            with self._lock:
+                self.n_responses += 1
+            yield 0xFF00, identifier
+
+    def instances(self, query):
+        for series in self.corpus:
+            if matches(query, series):
+                for n in range(1, int(series.NumberOfSeriesRelatedInstances) + 1):
+                    yield make_instance(series, n, self.pixels)
+
+    def move(self, event):
+        time.sleep(self.latency)
+        destination = self.destinations.get(event.move_destination.strip())
+        if destination is None:
+            yield None, None
+            return
+        yield destination
+        instances = list(self.instances(event.identifier))
+        yield len(instances)
+        for ds in instances:
+            yield 0xFF00, ds
+
+    def get(self, event):
+        time.sleep(self.latency)
+        instances = list(self.instances(event.identifier))
+        yield len(instances)
+        for ds in instances:
+            yield 0xFF00, ds
+
+
+class StandInStore:
+    ''' C-MOVE destination that only counts the received instances and bytes.
+    '''
+    def __init__(self, port=STORE_PORT):
+        self.n_instances = 0
+        self.n_bytes = 0
+        self._lock = threading.Lock()
+        self.ae = AE(STORE_AE_TITLE)
+        self.ae.add_supported_context(MRImageStorage)
+        self.server = self.ae.start_server((HOST, port), block=False, evt_handlers=[(evt.EVT_C_STORE, self.store)])
+
+    def stop(self):
+        self.server.shutdown()
+
+    def store(self, event):
+        with self._lock:
+            self.n_instances += 1
+            self.n_bytes += len(event.request.DataSet.getvalue())
+        return 0x0000
+
+
+class StandInArchive:
+    ''' Local HTTP server mimicking /tools/find and /series/<id>/archive of the AEM archive.
+    The archive ID of a series is its series instance UID. The next `errors`
+    requests are answered with 503, e.g. to test the retries of a client.
+    '''
+    def __init__(self, corpus, pixels, latency=0., port=ARCHIVE_PORT):
+        series = {ds.SeriesInstanceUID: ds for ds in corpus}
+        archive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, data, content_type):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def unavailable(self):
+                with archive._lock:
+                    archive.n_requests += 1
+                    if archive.errors <= 0:
+                        return False
+                    archive.errors -= 1
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return True
+
+            def do_POST(self):
+                time.sleep(archive.latency)
+                query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['Query']
+                if self.unavailable():
+                    return
+                uids = [uid for uid in query.get('SeriesInstanceUID', '').split('\\') if uid in series]
+                found = [{'ID': uid, 'MainDicomTags': {'SeriesInstanceUID': uid}} for uid in uids]
+                self.reply(json.dumps(found).encode(), 'application/json')
+
+            def do_GET(self):
+                time.sleep(archive.latency)
+                if self.unavailable():
+                    return
+                ds = series[self.path.strip('/').split('/')[1]]
+                self.reply(archive.series_zip(ds), 'application/zip')
+
+        self.pixels = pixels
+        self.latency = latency
+        self.errors = 0
+        self.n_requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((HOST, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def series_zip(self, series):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zip_ref:
+            for n in range(1, int(series.NumberOfSeriesRelatedInstances) + 1):
+                instance = io.BytesIO()
+                make_instance(series, n, self.pixels).save_as(instance, enforce_file_format=True)
+                zip_ref.writestr(f'{series.PatientID}/{series.StudyDescription}/{series.SeriesDescription}/IM{n:05d}.dcm',
+                                 instance.getvalue())
+        return buffer.getvalue()
+
+
+"""
+    Benchmarks
+"""
+def directory_size(path):
+    ''' Number of files and bytes under a directory.
+    '''
+    n_files = n_bytes = 0
+    for dirpath, _, files in os.walk(path):
+        for f in files:
+            n_files += 1
+            n_bytes += os.path.getsize(os.path.join(dirpath, f))
+    return n_files, n_bytes
+
+
+def peak_rss():
+    ''' Peak resident set size (MB) of this process and of its finished child processes.
+    '''
+    return {
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_rss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def bench_find(pacs, work_dir, n_patients, workers, window):
+    ''' find_studies.call_PACS over the days of the corpus.
+    '''
+    find_studies.AEC = {'ip': HOST, 'port': pacs.server.server_address[1]}
+    find_studies.AE_TITLE = AE_TITLE
+    n_queries = pacs.n_queries
+    cwd = os.getcwd()
+    os.chdir(work_dir)  # The output of call_PACS is written to the working directory
+    try:
+        start = time.perf_counter()
+        find_studies.call_PACS(START_DATE, n_patients, 'series', '', None, False, workers=workers, window=window,
+                               export='', resume=False)
+        seconds = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+    n_queries = pacs.n_queries - n_queries
+    return {'seconds': seconds, 'queries': n_queries, 'queries_per_s': n_queries / seconds}
+
+
+def bench_retrieve(pacs, corpus, out_dir, get, workers):
+    ''' retrieve_data.retrieve_series of all studies of the corpus, with C-MOVE and archive downloads or with C-GET.
+    '''
+    utils.OUT_DIR = out_dir
+    rows = sorted(set((int(ds.PatientID), ds.StudyDate) for ds in corpus))
+    kwargs = {'ae_title': AE_TITLE, 'addr': HOST, 'port': pacs.server.server_address[1]}
+    if get:
+        pool = PACSSessionPool(2 * workers, factory=get_session, out_dir=out_dir, **kwargs)
+    else:
+        retrieve_data.AEM = STORE_AE_TITLE
+        pool = PACSSessionPool(2 * workers, contexts=[StudyRootQueryRetrieveInformationModelFind,
+                                                      StudyRootQueryRetrieveInformationModelMove], **kwargs)
+    client = ArchiveClient(url=f'http://{HOST}:{ARCHIVE_PORT}', pool_size=2 * workers)
+
+    start = time.perf_counter()
+    with pool, client:
+        outputs, _ = retrieve_data.retrieve_series(rows, pool, client, get=get, query_workers=workers, move_workers=workers,
+                                                download_workers=workers, extract_workers=workers)
+    seconds = time.perf_counter() - start
+    n_files, n_bytes = directory_size(out_dir)
+    return {'seconds': seconds, 'series': len(outputs), 'files': n_files, 'bytes': n_bytes,
+            'series_per_min': len(outputs) / seconds * 60, 'files_per_s': n_files / seconds,
+            'mb_per_s': n_bytes / 1e6 / seconds}
+
+
+def bench_anonymize(src_dir, work_dir, workers):
+    ''' anonymize_data.main over the retrieved series, laid out as <patient>/<study>/<series>/<file>.
+    '''
+    anonymize_data.SRCDIR = os.path.join(work_dir, 'extracted')
+    anonymize_data.DSTDIR = os.path.join(work_dir, 'anonymized')
+    anonymize_data.MANIFEST_FILE = os.path.join(work_dir, 'manifest.sqlite')
+    anonymize_data.UID_FILE = os.path.join(work_dir, 'uids.sqlite')
+    anonymize_data.PSEUDONYM_FILE = os.path.join(work_dir, 'pseudonyms.sqlite')
+    for study in os.listdir(src_dir):
+        # <pid>-<date>/<series> of OUT_DIR becomes <10-digit pid>-<date>/MR/<series>
+        patient_folder = os.path.join(anonymize_data.SRCDIR, study.zfill(len(study) - study.index('-') + 10))
+        os.makedirs(patient_folder)
+        os.symlink(os.path.abspath(os.path.join(src_dir, study)), os.path.join(patient_folder, 'MR'))
+
+    start = time.perf_counter()
+    anonymize_data.main(['--workers', str(workers), '--all', '--metrics', ''], standalone_mode=False)
+    seconds = time.perf_counter() - start
+    n_files, n_bytes = directory_size(anonymize_data.DSTDIR)
+    return {'seconds': seconds, 'files': n_files, 'files_per_s': n_files / seconds, 'mb_per_s': n_bytes / 1e6 / seconds}
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(results, baseline_file):
+    ''' Print the ratio of every throughput to the one of a previous benchmark.
+    '''
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    print(f"Compared to {baseline['version']} ({baseline['date']}):")
+    for name, metrics in results['results'].items():
+        for metric, value in metrics.items():
+            previous = baseline['results'].get(name, {}).get(metric)
+            if metric.endswith(('_per_s', '_per_min')) and previous:
+                print(f'  {name} {metric}: {value:.1f} ({value / previous:.2f}x)')
+
+
+@click.command()
+@click.option('--patients', default=20, type=int, help='The number of patients (one study per day) of the corpus.')
+@click.option('--series', default=3, type=int, help='The number of series per study.')
+@click.option('--instances', default=20, type=int, help='The number of instances per series.')
+@click.option('--matrix', default=256, type=int, help='The number of rows and columns of an instance.')
+@click.option('--latency', default=0., type=float, help='The delay of every PACS and archive request (s).')
+@click.option('--workers', default=2, type=int, help='The number of parallel workers of every stage.')
+@click.option('--window', default=7, type=int, help='The number of days per date range query of find_studies.')
+@click.option('--stages', default='find,move,get,anonymize', type=str, help='The benchmarks to run, separated by commas.')
+@click.option('--output', default='benchmark.json', type=str, help='The JSON file the results are saved to.')
+@click.option('--baseline', default='', type=str, help='The JSON file of a previous benchmark to compare with.')
+def main(patients, series, instances, matrix, latency, workers, window, stages, output, baseline):
+    stages = stages.split(',')
+    corpus = make_corpus(patients, series, instances)
+    pixels = (np.arange(matrix * matrix, dtype=np.uint16) % 4096).tobytes()
+    print(f'Corpus: {patients} studies, {len(corpus)} series, {len(corpus) * instances} instances '
+          f'of {len(pixels) / 1024:.0f} KB')
+
+    store = StandInStore()
+    pacs = StandInPACS(corpus, pixels, latency, destinations={STORE_AE_TITLE: (HOST, STORE_PORT)})
+    archive = StandInArchive(corpus, pixels, latency)
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            utils.TMP_DIR = work_dir
+            if 'find' in stages:
+                results['find'] = bench_find(pacs, work_dir, patients, workers, window)
+            if 'move' in stages:
+                results['move'] = bench_retrieve(pacs, corpus, os.path.join(work_dir, 'move'), False, workers)
+            if 'get' in stages:
+                results['get'] = bench_retrieve(pacs, corpus, os.path.join(work_dir, 'get'), True, workers)
+            if 'anonymize' in stages:
+                src_dir = os.path.join(work_dir, 'get' if 'get' in stages else 'move')
+                if not os.path.exists(src_dir):
+                    bench_retrieve(pacs, corpus, src_dir, True, workers)
+                results['anonymize'] = bench_anonymize(src_dir, os.path.join(work_dir, 'anonymize'), workers)
+    finally:
+        pacs.stop()
+        store.stop()
+        archive.stop()
+
+    results = {
+        'version': git_version(), 'date': datetime.now().isoformat(timespec='seconds'),
+        'parameters': {'patients': patients, 'series': series, 'instances': instances, 'matrix': matrix,
+                       'latency': latency, 'workers': workers, 'window': window},
+        'results': results, 'memory': peak_rss(), 'metrics': METRICS.summary(),
+    }
+    print(json.dumps({key: value for key, value in results.items() if key != 'metrics'}, indent=2))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Saved {output}')
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main(standalone_mode=False)
@@ -0,0 +1,118 @@
+import os
+import sqlite3
+import time
+import pandas as pd
+
+# Parameters
+CURSOR_FILE = "../../tmp/dicom/cohort_cursors.sqlite"
+PATIENT_COLUMN = "Patient"
+DATE_COLUMN = "MRI_StudyDate"
+CHUNK_ROWS = 50000  # Number of input rows read at once
+
+
+def read_chunks(path, chunk_rows=CHUNK_ROWS, sheet_name=0, skip_rows=0):
+    ''' Read the patient ID and study date columns of a cohort file in chunks of rows.
+    CSV and Parquet files are streamed, only Excel files are read at once,
+    as they cannot be read in parts. The other columns are never loaded.
+    Args:
+        path: CSV, Excel (.xlsx/.xls) or Parquet file
+        sheet_name: sheet of an Excel file
+        skip_rows: number of data rows to skip at the start of the file
+    Return:
+        iterator of DataFrames with the two columns
+    '''
+    columns = [PATIENT_COLUMN, DATE_COLUMN]
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.xlsx', '.xlsm', '.xls'):
+        df = pd.read_excel(path, sheet_name, usecols=columns, dtype=str)
+        yield from (df[i:i + chunk_rows] for i in range(skip_rows, len(df), chunk_rows))
+    elif ext == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(chunk_rows, columns=columns):
+            if skip_rows >= batch.num_rows:
+                skip_rows -= batch.num_rows
+                continue
+            yield batch.slice(skip_rows).to_pandas()
+            skip_rows = 0
+    else:
+        yield from pd.read_csv(path, usecols=columns, dtype=str, chunksize=chunk_rows,
+                               skiprows=range(1, skip_rows + 1))
+
+
+def normalize_rows(df):
+    ''' Parse the patient IDs and study dates of a chunk and drop the invalid and duplicate rows.
+    The study dates may be dates, datetimes or ISO 8601 strings, with or without time.
+    Return:
+        DataFrame with the integer Patient and the yyyymmdd StudyDate columns
+    '''
+    dates = df[DATE_COLUMN]
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.to_datetime(dates.astype(str), format='ISO8601', errors='coerce')
+    rows = pd.DataFrame({
+        'Patient': pd.to_numeric(df[PATIENT_COLUMN], errors='coerce'),
+        'StudyDate': dates.dt.strftime('%Y%m%d'),
+    })
+    invalid = rows['Patient'].isna() | rows['StudyDate'].isna()
+    if invalid.any():
+        print(f'Skipping {invalid.sum()} rows without a valid patient ID or study date')
+    return rows[~invalid].astype({'Patient': int}).drop_duplicates()
+
+
+def read_studies(path, chunk_rows=CHUNK_ROWS, sheet_name=0, start=0):
+    ''' Read the studies of a cohort file lazily, each (patient ID, study date) once.
+    Args:
+        start: number of data rows to skip, e.g. the cursor of an interrupted run
+    Return:
+        iterator of (number of rows read, list of new (patient ID, yyyymmdd study date) of the chunk),
+        the studies in input order
+    '''
+    seen = set()
+    n_rows = start
+    for chunk in read_chunks(path, chunk_rows, sheet_name, start):
+        n_rows += len(chunk)
+        studies = [row for row in normalize_rows(chunk).itertuples(index=False, name=None) if row not in seen]
+        seen.update(studies)
+        print(f'{n_rows} rows read, {len(studies)} new studies of {len(chunk)} rows')
+        yield n_rows, studies
+
+
+class CohortCursor:
+    ''' Persistent number of rows processed per cohort file, to resume an interrupted run.
+    The cursor of a file is reset when the file changes.
+    Args:
+        path: SQLite database file
+    '''
+    def __init__(self, path=CURSOR_FILE):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS cursors (
+                file TEXT PRIMARY KEY, size INTEGER, mtime REAL, rows INTEGER, updated REAL
+            )
+        ''')
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def get(self, file):
+        ''' Number of rows of a file processed so far, 0 if none or if the file changed since.
+        '''
+        stat = os.stat(file)
+        row = self._conn.execute('SELECT size, mtime, rows FROM cursors WHERE file = ?', (os.path.abspath(file),)).fetchone()
+        if row is None or row[:2] != (stat.st_size, stat.st_mtime):
+            return 0
+        return row[2]
+
+    def set(self, file, rows):
+        stat = os.stat(file)
+        with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?, ?)',
+                               (os.path.abspath(file), stat.st_size, stat.st_mtime, rows, time.time()))
@@ -0,0 +1,188 @@
+from datetime import datetime, timedelta
+import copy
+import hashlib
+import sys
+import time
+import pydicom
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+
+from uid_map import INSTANCE_UIDS
+
+# Actions of a de-identification profile
+REMOVE = 'remove'    # Delete the element
+BLANK = 'blank'      # Keep the element with an empty value
+REPLACE = 'replace'  # Set the value given when applying the profile (added if missing)
+HASH = 'hash'        # Replace the value by a salted hash
+SHIFT = 'shift'      # Shift a date by a fixed number of days
+UID = 'uid'          # Remap the UID with a UIDMap
+
+# Default profile, based on the DICOM standard for de-identification (Table E.1-1)
+PROFILE = {
+    'PatientID': REPLACE, 'PatientName': REPLACE,
+    'OtherPatientIDs': REMOVE, 'OtherPatientNames': REMOVE, 'PatientBirthDate': REMOVE, 'PatientBirthTime': REMOVE,
+    'PatientSex': REMOVE, 'PatientAge': REMOVE, 'PatientAddress': REMOVE, 'PatientMotherBirthName': REMOVE,
+    'PatientTelephoneNumbers': REMOVE, 'PatientInsurancePlanCodeSequence': REMOVE,
+    'PatientPrimaryLanguageCodeSequence': REMOVE,
+    'ResponsiblePerson': REMOVE, 'ResponsiblePersonRole': REMOVE, 'ResponsibleOrganization': REMOVE,
+    'IssuerOfPatientID': REMOVE, 'IssuerOfPatientIDQualifiersSequence': REMOVE,
+    'AccessionNumber': REMOVE, 'InstitutionName': REMOVE, 'InstitutionAddress': REMOVE,
+    'InstitutionalDepartmentName': REMOVE, 'ReferringPhysicianName': REMOVE,
+    'ReferringPhysicianTelephoneNumbers': REMOVE,
+    'PhysiciansOfRecord': REMOVE, 'PerformingPhysicianName': REMOVE, 'OperatorsName': REMOVE,
+    'StudyDate': REMOVE, 'SeriesDate': REMOVE, 'AcquisitionDate': REMOVE, 'ContentDate': REMOVE,
+    'StudyTime': REMOVE, 'SeriesTime': REMOVE, 'AcquisitionTime': REMOVE, 'ContentTime': REMOVE,
+    'StudyID': REMOVE, 'StudyDescription': REMOVE, 'SeriesDescription': REMOVE,
+    'DeviceSerialNumber': REMOVE, 'StationName': REMOVE, 'Manufacturer': REMOVE, 'ManufacturerModelName': REMOVE,
+    'SoftwareVersions': REMOVE, 'ProtocolName': REMOVE, 'DeviceUID': REMOVE,
+    'ScheduledProcedureStepDescription': REMOVE,
+}
+PROFILE.update({keyword: UID for keyword in INSTANCE_UIDS})
+
+
+class CompiledProfile:
+    ''' De-identification profile compiled to a lookup of tags to actions.
+
+    The profile is compiled once per process and applied in a single walk
+    over the dataset, which recurses into sequences and removes private tags
+    in the same pass.
+    Args:
+        profile: dict of element keyword to action
+        uid_map: UIDMap used for the UID action, required if the profile has UID actions
+        salt: secret mixed into the HASH action
+        date_shift: number of days added by the SHIFT action
+    Raise:
+        ValueError if a keyword is unknown, or if there are UID actions without uid_map
+    '''
+    def __init__(self, profile=PROFILE, uid_map=None, salt='', date_shift=0):
+        self.actions = {}
+        for keyword, action in profile.items():
+            tag = tag_for_keyword(keyword)
+            if tag is None:
+                raise ValueError(f'Unknown keyword in de-identification profile: {keyword}')
+            self.actions[tag] = action
+        self.replace = [tag for tag, action in self.actions.items() if action == REPLACE]
+        if uid_map is None and UID in self.actions.values():
+            # Skipping the UID actions would keep the original UIDs
+            raise ValueError('The de-identification profile remaps UIDs, a uid_map is required')
+        self.uid_map = uid_map
+        self.salt = salt
+        self.date_shift = timedelta(days=date_shift)
+
+    def apply(self, ds, values=None):
+        ''' De-identify a dataset in place.
+        Args:
+            ds: dataset
+            values: dict of keyword to value for the REPLACE action
+        '''
+        values = {tag_for_keyword(keyword): value for keyword, value in (values or {}).items()}
+        self._walk(ds, values)
+
+        # Replaced elements are added if they are missing
+        for tag in self.replace:
+            if tag not in ds and tag in values:
+                ds.add_new(tag, dictionary_VR(tag), values[tag])
+
+    def _walk(self, ds, values):
+        for tag in list(ds.keys()):
+            if tag.is_private:
+                del ds[tag]
+                continue
+
+            action = self.actions.get(tag)
+            if action is None:
+                elem = ds[tag]
+                if elem.VR == 'SQ':
+                    for item in elem.value:
+                        self._walk(item, values)
+            elif action == REMOVE:
+                del ds[tag]
+            elif action == BLANK:
+                elem = ds[tag]
+                elem.value = [] if elem.VR == 'SQ' else ''
+            elif action == REPLACE:
+                if tag in values:
+                    ds[tag].value = values[tag]
+                else:
+                    del ds[tag]
+            else:
+                elem = ds[tag]
+                if elem.value in (None, '') or elem.VR == 'SQ':
+                    continue
+                value = [str(v) for v in elem.value] if elem.VM > 1 else [str(elem.value)]
+                if action == UID:
+                    value = [self.uid_map.map(v) for v in value]
+                elif action == HASH:
+                    value = [hashlib.sha256(f'{self.salt}{v}'.encode()).hexdigest()[:16] for v in value]
+                elif action == SHIFT:
+                    value = [self._shift(v) for v in value]
+                elem.value = value if elem.VM > 1 else value[0]
+
+    def _shift(self, value):
+        ''' Shift a date (DA) or the date part of a date time (DT).
+        '''
+        try:
+            date = datetime.strptime(value[:8], '%Y%m%d') + self.date_shift
+        except ValueError:
+            return ''
+        return date.strftime('%Y%m%d') + value[8:]
+
+
+def _legacy_anonymize(ds, anonymized_id):
+    ''' Header anonymization before the compiled profile, kept for the benchmark.
+    '''
+    ds.PatientID = anonymized_id
+    ds.PatientName = "ANONYMIZED"
+    ds.PatientBirthDate = ''
+    ds.PatientAddress = ''
+    tags_to_remove = [
+        'OtherPatientIDs', 'OtherPatientNames', 'PatientBirthDate', 'PatientBirthTime',
+        'PatientSex', 'PatientAge', 'PatientAddress', 'PatientMotherBirthName',
+        'PatientTelephoneNumbers', 'PatientInsurancePlanCodeSequence', 'PatientPrimaryLanguageCodeSequence',
+        'ResponsiblePerson', 'ResponsiblePersonRole', 'ResponsibleOrganization',
+        'IssuerOfPatientID', 'IssuerOfPatientIDQualifiersSequence', 'PatientID',
+        'AccessionNumber', 'InstitutionName', 'InstitutionAddress',
+        'InstitutionalDepartmentName', 'ReferringPhysicianName', 'ReferringPhysicianTelephoneNumbers',
+        'PhysiciansOfRecord', 'PerformingPhysicianName', 'OperatorsName',
+        'StudyDate', 'SeriesDate', 'AcquisitionDate', 'ContentDate',
+        'StudyTime', 'SeriesTime', 'AcquisitionTime', 'ContentTime',
+        'StudyID', 'StudyDescription', 'SeriesDescription', 'PhysicianOfRecord',
+        'PerformingPhysicianName', 'DeviceSerialNumber', 'InstitutionalDepartmentName',
+        'StationName', 'Manufacturer', 'ManufacturerModelName', 'SoftwareVersions',
+        'ProtocolName', 'DeviceUID', 'StationName', 'ScheduledProcedureStepDescription'
+    ]
+    for tag_keyword in tags_to_remove:
+        tag = tag_for_keyword(tag_keyword)
+        if tag in ds:
+            del ds[tag]
+    ds.remove_private_tags()
+    ds.StudyInstanceUID = ''
+    ds.SeriesInstanceUID = ''
+    ds.SOPInstanceUID = ''
+
+
+def benchmark(dicom_file, n=1000):
+    ''' Compare the per-file header cost of the legacy anonymization and the compiled profile.
+    '''
+    from uid_map import UIDMap
+    header = pydicom.dcmread(dicom_file, stop_before_pixels=True)
+    profile = CompiledProfile(uid_map=UIDMap())
+    copies = [copy.deepcopy(header) for _ in range(2 * n)]
+
+    start = time.perf_counter()
+    for ds in copies[:n]:
+        _legacy_anonymize(ds, '0123456789')
+    legacy = (time.perf_counter() - start) / n
+
+    start = time.perf_counter()
+    for ds in copies[n:]:
+        profile.apply(ds, {'PatientID': '0123456789', 'PatientName': 'ANONYMIZED'})
+    compiled = (time.perf_counter() - start) / n
+
+    print(f'Legacy:   {legacy * 1e6:.1f} us/file')
+    print(f'Compiled: {compiled * 1e6:.1f} us/file ({legacy / compiled:.1f}x)')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit('Usage: python deid_profile.py <dicom file> [number of copies, 1000 by default]')
+    benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
@@ -1,3 +1,5 @@
+import re
+
 anat_series = [
     't1_mprage_sag_p2',
     't1_mprage_sag_p2_iso',
@@ -19,3 +21,32 @@ diff_series = [
     'b_1ooot',
     'b_1ooo'
 ]
+
+# Body parts of neuroimaging studies
+body_parts = frozenset(['BRAIN', 'HEAD', 'SKULL'])
+
+# Disease protocols, and the series lists of those that do not use all anat, func and diff series
+PROTOCOLS = ['stroke']
+protocol_series = {}
+
+
+def compile_series_filter(protocol=None):
+    ''' Compile the series lists into a matcher of series descriptions.
+    Args:
+        protocol: protocol whose series list is used, all anat, func and diff series if None or if it has no own list
+    Raise:
+        ValueError if the protocol is unknown
+    Return:
+        function returning True if a series description is in the list
+    '''
+    if protocol is not None and protocol not in PROTOCOLS:
+        raise ValueError(f'Unknown protocol {protocol}, choose one of {PROTOCOLS}')
+    series = frozenset(protocol_series.get(protocol, anat_series + func_series + diff_series))
+    return series.__contains__
+
+
+def compile_wildcard(pattern):
+    ''' Compile a DICOM wildcard pattern (* and ?) into a matcher of series descriptions.
+    '''
+    regex = re.compile(''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in pattern), re.DOTALL)
+    return lambda description: regex.fullmatch(description) is not None
@@ -1,135 +1,194 @@
 import click
-import pandas as pd
-from datetime import datetime, timedelta
-import time
+from datetime import datetime
 from pydicom.dataset import Dataset
-from pynetdicom import AE, debug_logger
-from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
 
 from filter_items import *
-from utils import calculate_previous_date, convert_date_format
+from index_data import join_index, MetadataIndex
+from metrics import instrument, METRICS
+from query_cache import QueryCache
+from utils import convert_date_format, date_windows, split_date_range, PACSSessionPool, StreamWriter
 
 # Parameters
 IP = ""
-PORT = 
+PORT = 4100
 TODAY = ''.join(str(datetime.now())[:10].split('-'))
 AEC = {'ip': IP, 'port': PORT}
 AET = ""
 AE_TITLE = ""
+MAX_ASSOCIATIONS = 4  # Maximum number of concurrent associations accepted by the PACS
+MAX_RESPONSES = 500  # Maximum number of C-FIND responses returned by the PACS per query
 
 
-def call_PACS(date, days, level, pid, protocol, filter):
+def build_query(date, level, pid, body_part='', series=''):
+    ''' Create a DICOM query dataset for one study date or date range (yyyymmdd-yyyymmdd).
+    The body part and series description (wildcards allowed) are matched by the PACS.
+    '''
+    ds = Dataset()
+    ds.StudyDate = date              # 0008,0020
+    ds.AccessionNumber = ""          # 0008,0050
+    ds.StudyDescription = ""         # 0008,1030
+    ds.Modality = "MR"               # 0008,0060
+    ds.PatientID = pid               # 0010,0020
+    ds.BodyPartExamined = body_part  # 0018,0015
+    ds.QueryRetrieveLevel = level.upper()  # 0008,0052
+    ds.StudyInstanceUID = ""         # 0020,000d
+    ds.PatientBirthDate = ""         # 0010,0030
+
+    if level == 'series':
+        ds.SeriesInstanceUID = ""        # 0020,000e
+        ds.SeriesDescription = series    # 0008,103e
+    return ds
+
+
+def find_window(session, window, query, limit):
+    ''' Query a date window with a single date range match.
+    The window is split in two halves as long as the number of responses
+    reaches the limit, so that no study is dropped by the PACS result cap.
+    Args:
+        query: keyword arguments of build_query besides the date
+    Return:
+        list of identifiers, None if a query failed
+    '''
+    start, end = window
+    date = start if start == end else f'{start}-{end}'
+    responses = session.find(build_query(date, **query))
+    if responses is None:
+        return None
+
+    if limit and len(responses) >= limit:
+        if start != end:
+            older, newer = split_date_range(start, end)
+            print(f'{date}: {len(responses)} responses, splitting')
+            newer = find_window(session, newer, query, limit)
+            older = find_window(session, older, query, limit) if newer is not None else None
+            return None if older is None else newer + older
+        print(f'Warning: {len(responses)} responses on {date} reached the limit of {limit}, results may be incomplete.')
+    return responses
+
+
+def study_age(study_date, birth_date):
+    ''' Age of the patient in years at the study date.
+    '''
+    return convert_date_format(study_date).year - convert_date_format(birth_date).year
+
+
+def query_window(session, window, query, series_filters, limit):
+    ''' Query a date window and return the rows of matching studies/series.
+    Args:
+        query: keyword arguments of build_query besides the date
+        series_filters: matchers that a series description has to pass
+    Return:
+        list of rows, None if the window could not be queried
+    '''
+    rows = []
+    ages = {}
+    print(f'Querying {window[0]}-{window[1]}')
+
+    # Use C-FIND to query the PACS, newest date first
+    with METRICS.timer('find_window_seconds'):
+        responses = find_window(session, window, query, limit)
+    if responses is None:
+        return None
+    responses = sorted(responses, key=lambda x: x.get('StudyDate', ''), reverse=True)
+
+    for identifier in responses:
+        # 'identifier' contains the dataset with retrieved information
+        # Check if the study contains brain scans, in case the PACS ignores the body part key
+        body_part = identifier.get('BodyPartExamined', 'N/A')
+        if body_part not in body_parts or (query['body_part'] and body_part != query['body_part']):
+            continue
+
+        # Only find series of neuroimaging of adults, computing the age once per study
+        study_uid = identifier.get('StudyInstanceUID', 'N/A')
+        study_date = identifier.get('StudyDate')
+        if study_uid not in ages:
+            ages[study_uid] = study_age(study_date, identifier.get('PatientBirthDate'))
+        age = ages[study_uid]
+        if age < 18:
+            continue
+
+        # Series level: keep items if series pass the series filters
+        if query['level'] == 'series':
+            series_item = identifier.get('SeriesDescription', 'N/A')
+            if not all(match(series_item) for match in series_filters):
+                continue
+
+        print('Response: ', body_part, study_date, age)
+        row = {
+            'StudyDate': study_date,
+            'AccessionNumber': identifier.get('AccessionNumber', 'N/A'),
+            'PatientID': identifier.get('PatientID', 'N/A'),
+            'Age': age,
+            'BodyPartExamined': body_part,
+            'StudyDescription': identifier.get('StudyDescription', 'N/A'),
+            'StudyInstanceUID': study_uid,
+        }
+        if query['level'] == 'series':
+            row['SeriesDescription'] = series_item
+            row['SeriesInstanceUID'] = identifier.get('SeriesInstanceUID', 'N/A')
+        rows.append(row)
+    return rows
+
+
+def call_PACS(date, days, level, pid, protocol, filter, rate=0, workers=1, window=1, limit=MAX_RESPONSES, cache=None,
+              body_part='', series='', fmt='csv', export='xlsx', resume=True, index=False):
     ''' Call GEPACS to get data information.
+    The days are queried in windows of `window` days with date range
+    matching. The windows are spread over up to `workers` associations,
+    which are only re-established if the PACS drops them. Results are
+    merged in date order, independent of the number of workers. Responses
+    found in the cache are not queried again.
+    The body part and the series description wildcard are sent to the PACS,
+    the series lists of the protocol are matched locally.
+    The rows are appended to a CSV or JSONL file after every window, and an
+    interrupted sweep resumes after the last completed window.
+    With index, the exported rows are joined with the series already on disk.
     '''
-    # Params to store data
-    study_dates = []
-    accession_numbers = []
-    study_descriptions = []
-    patient_ids = []
-    body_parts = []
-    study_uids = []
-    series_uids = []
-    series_descriptions = []
-    ages = []
-
-    # Iterate over days from the specified date
+    # Iterate over date windows from the specified date
     date0 = date
-    for i in range(days):
-        if i == 0:
-            date = date0
-        else:
-            date = calculate_previous_date(date0, days=i)
-
-        print('-'*20)
-        print(f'{i}: {date}')
-
-        # Create a DICOM query dataset
-        ds = Dataset()
-        ds.StudyDate = date              # 0008,0020
-        ds.AccessionNumber = ""          # 0008,0050
-        ds.StudyDescription = ""         # 0008,1030
-        ds.Modality = "MR"               # 0008,0060
-        ds.PatientID = pid               # 0010,0020
-        ds.BodyPartExamined = ""         # 0018,0015
-        ds.QueryRetrieveLevel = level.upper()  # 0008,0052
-        ds.StudyInstanceUID = ""         # 0020,000d
-        ds.PatientBirthDate = ""         # 0010,0030
-
-        if level == 'series':
-            ds.SeriesInstanceUID = ""        # 0020,000e
-            ds.SeriesDescription = ""        # 0008,103e
-
-        # Create association with the PACS server
-        ae = AE(ae_title=AE_TITLE)
-        ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)  # Add the relevant DICOM service UID for query/retrieve
-
-        # Start association with the PACS 
-        assoc = ae.associate(AEC['ip'], AEC['port'], ae_title=b"GEPACS")
-
-        if assoc.is_established:
-            # Use C-FIND to query the PACS
-            responses = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind) 
-          
-            for j, (status, identifier) in enumerate(responses):
-                if status:
-                    #print("C-FIND Query Status: 0x{0:04x}".format(status.Status))
-                    # 'identifier' contains the dataset with retrieved information
-                    # Process the retrieved DICOM dataset as needed
-                    if identifier is not None:
-                        # Check if the study contains brain scans
-                        body_part = identifier.get('BodyPartExamined', 'N/A')
-                        study_description = identifier.get('StudyDescription', 'N/A')
-                        study_date = identifier.get('StudyDate')
-                        bd = identifier.get('PatientBirthDate')
-                        yy, mm, dd = int(study_date[:4]), int(study_date[4:6]), int(study_date[6:])
-                        age = convert_date_format(study_date).year - convert_date_format(bd).year
-
-                        # Only find series of neuroimaging of adults
-                        if body_part in ['BRAIN', 'HEAD', 'SKULL'] and age >= 18:
-                            print('Response: ', body_part, study_date, age)
-
-                            # Series level: keep items if series contain anat, func or diff series
-                            if level == 'series':
-                                series_item = identifier.get('SeriesDescription', 'N/A')
-                                if filter:
-                                    if (series_item in anat_series) or (series_item in func_series) or (series_item in diff_series):
-                                        series_uids.append(identifier.get('SeriesInstanceUID', 'N/A'))
-                                        series_descriptions.append(series_item)
-                                    else:
-                                        continue
-                                else:
-                                    series_uids.append(identifier.get('SeriesInstanceUID', 'N/A'))
-                                    series_descriptions.append(series_item)
-
-                            # Append data
-                            study_dates.append(study_date)
-                            accession_numbers.append(identifier.get('AccessionNumber', 'N/A'))
-                            study_descriptions.append(identifier.get('StudyDescription', 'N/A'))
-                            patient_ids.append(identifier.get('PatientID', 'N/A'))
-                            body_parts.append(body_part)
-                            study_uids.append(identifier.get('StudyInstanceUID', 'N/A'))
-                            ages.append(age)
-
-                else:
-                    print("C-FIND Failed")
-
-            # Release the association
-            assoc.release()
-        else:
-            print("Association rejected, aborted or never connected!")
-
-        # Pause for some time
-        time.sleep(2)
-
-    # Create text file
-    df = pd.DataFrame(
-        list(zip(study_dates, accession_numbers, patient_ids, ages, body_parts, study_descriptions, study_uids)),
-        columns=['StudyDate', 'AccessionNumber', 'PatientID', 'Age', 'BodyPartExamined', 'StudyDescription', 'StudyInstanceUID']
-    )
+    windows = date_windows(date0, days, window)
+
+    query = {'level': level, 'pid': pid, 'body_part': body_part, 'series': series}
+    series_filters = []
+    if filter:
+        series_filters.append(compile_series_filter(protocol))
+    if series:
+        series_filters.append(compile_wildcard(series))
+
+    # Stream the rows of every window to the output file
+    columns = ['StudyDate', 'AccessionNumber', 'PatientID', 'Age', 'BodyPartExamined', 'StudyDescription', 'StudyInstanceUID']
     if level == 'series':
-        df['SeriesDescription'] = series_descriptions
-        df['SeriesInstanceUID'] = series_uids
-    df.to_excel(f'studies_available-{protocol}-{level}-{date0}-{days}.xlsx')
+        columns += ['SeriesDescription', 'SeriesInstanceUID']
+    # The rows of a checkpoint are only reused by a sweep with the same query, filters and windows
+    params = dict(query, protocol=protocol, filter=bool(filter), window=window, limit=limit)
+    writer = StreamWriter(f'studies_available-{protocol}-{level}-{date0}-{days}.{fmt}', columns, dtypes={'Age': int},
+                          resume=resume, params=params)
+    todo = [w for w in windows if not writer.is_done(f'{w[0]}-{w[1]}')]
+    if len(todo) < len(windows):
+        print(f'Resuming: {len(windows) - len(todo)} of {len(windows)} windows already done')
+
+    workers = min(workers, MAX_ASSOCIATIONS)
+    with PACSSessionPool(workers, rate=rate, ae_title=AE_TITLE, addr=AEC['ip'], port=AEC['port'], cache=cache) as pool:
+        query_fn = lambda session, window: query_window(session, window, query, series_filters, limit)
+        for i, (window, window_rows) in enumerate(zip(todo, pool.map(query_fn, todo))):
+            print('-'*20)
+            if window_rows is None:
+                # Not checkpointed, so that the window is queried again on resume
+                print(f'{i}: {window[0]}-{window[1]} failed')
+                continue
+            print(f'{i}: {window[0]}-{window[1]} ({len(window_rows)} items)')
+            writer.write(f'{window[0]}-{window[1]}', window_rows)
+        pool.report()
+    if cache is not None:
+        cache.report()
+
+    # Convert the output file
+    if export:
+        df = None
+        if index:
+            with MetadataIndex() as metadata_index:
+                df = join_index(writer.read(), metadata_index)
+        print(f'Saved {writer.convert(export, df)}')
 
 
 @click.command()
@@ -137,9 +196,22 @@ def call_PACS(date, days, level, pid, protocol, filter):
 @click.option('--days', default=1, type=int, help='The number of days from the specified date backward.')
 @click.option('--level', default='series', type=str, help='The query level: "study" or "series".')
 @click.option('--pid', default='', type=str, help='The patient ID.')
-@click.option('--protocol', default=None, type=str, help=f'The disease protocol used for image acquisition: {PROTOCOLS}.')
+@click.option('--protocol', default=None, type=str, help=f'The disease protocol used for image acquisition, one of {PROTOCOLS} with --filter.')
 @click.option('--filter', default=False, type=bool, help='Whether to filter specific sequences.')
-def main(date, days, level, pid, protocol, filter):
+@click.option('--body-part', default='', type=str, help=f'The body part matched by the PACS, one of {sorted(body_parts)} (all if empty).')
+@click.option('--series', default='', type=str, help='The series description matched by the PACS, wildcards * and ? allowed.')
+@click.option('--rate', default=0., type=float, help='The maximum number of queries per second (0 for no limit).')
+@click.option('--workers', default=1, type=int, help=f'The number of parallel associations (at most {MAX_ASSOCIATIONS}).')
+@click.option('--window', default=30, type=int, help='The number of days per date range query, split while it reaches --limit.')
+@click.option('--limit', default=MAX_RESPONSES, type=int, help='The response count at which a date range query is split in two.')
+@click.option('--cache/--no-cache', default=True, help='Whether to reuse cached C-FIND responses.')
+@click.option('--refresh', is_flag=True, help='Query the PACS again and refresh the cached responses.')
+@click.option('--format', 'fmt', default='csv', type=click.Choice(['csv', 'jsonl']), help='The format of the streamed output file.')
+@click.option('--export', default='xlsx', type=click.Choice(['xlsx', 'parquet', '']), help='The format the output is converted to at the end (none if empty).')
+@click.option('--resume/--restart', default=True, help='Whether to resume an interrupted sweep from its checkpoint.')
+@click.option('--index', is_flag=True, help='Join the exported output with the series on disk, from the index of index_data.py.')
+@instrument('find_studies')
+def main(date, days, level, pid, protocol, filter, body_part, series, rate, workers, window, limit, cache, refresh, fmt, export, resume, index):
     # Date format
     assert len(date) == 8, print('The date format should be yyyymmdd.')
     assert level in ['study', 'series'], print('Choose a query level: "study" or "series".')
@@ -148,7 +220,9 @@ def main(date, days, level, pid, protocol, filter):
     print('='*60)
     print(f'Retrieving MR data from GEPACS, starting from {date} backward...')
     print('='*60)
-    call_PACS(date, days, level, pid, protocol, filter)
+    cache = QueryCache(refresh=refresh) if cache else None
+    call_PACS(date, days, level, pid, protocol, filter, rate, workers, window, limit, cache, body_part, series,
+              fmt, export, resume, index)
 
 
 if __name__ == "__main__":
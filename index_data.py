@@ -0,0 +1,192 @@
+import click
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import os
+import pandas as pd
+import pydicom
+import sqlite3
+import threading
+
+from metrics import instrument, METRICS
+from series_store import SeriesStore, STORE_INDEX
+from utils import OUT_DIR
+
+INDEX_FILE = "../../tmp/dicom/index.sqlite"
+TAGS = ['PatientID', 'StudyDate', 'StudyInstanceUID', 'SeriesInstanceUID', 'SeriesDescription', 'SOPInstanceUID']
+
+
+def read_header(path):
+    ''' Read the indexed header elements of a dicom file, without its pixel data.
+    Return:
+        (path, directory, size, mtime, *TAGS), None if the file cannot be read
+    '''
+    try:
+        stat = os.stat(path)
+        ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=TAGS)
+    except Exception as e:
+        print(f'Skipping {path}: {e}')
+        return None
+    return (path, os.path.dirname(path), stat.st_size, stat.st_mtime) + tuple(str(ds.get(tag, '')) for tag in TAGS)
+
+
+class MetadataIndex:
+    ''' SQLite index of the dicom files on disk, by patient, study and series.
+
+    The index is updated incrementally: only new or changed files are read,
+    with header-only reads spread over a process pool, and deleted files
+    are dropped. Lookups can be shared by the threads of a pipeline.
+    Args:
+        path: SQLite database file
+    '''
+    def __init__(self, path=INDEX_FILE):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS instances (
+                path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime REAL,
+                patient_id TEXT, study_date TEXT, study_uid TEXT, series_uid TEXT,
+                series_description TEXT, sop_uid TEXT
+            );
+            CREATE INDEX IF NOT EXISTS instances_series ON instances (series_uid);
+            CREATE INDEX IF NOT EXISTS instances_patient ON instances (patient_id, study_date);
+            CREATE VIEW IF NOT EXISTS series AS
+                SELECT patient_id, study_date, study_uid, series_uid, series_description,
+                       COUNT(DISTINCT sop_uid) AS n_instances, SUM(size) AS size, MIN(dir) AS dir
+                FROM instances GROUP BY series_uid, dir;
+        ''')
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def update(self, roots, workers=None, chunksize=64):
+        ''' Index the new and changed dicom files under the root directories and drop deleted ones.
+        The instances packed by series_store.py are taken from the header index of their store.
+        Return:
+            number of files read
+        '''
+        known = {path: (size, mtime) for path, size, mtime in self._conn.execute('SELECT path, size, mtime FROM instances')}
+        found = set()
+        todo = []
+        for root in roots:
+            for dirpath, _, files in os.walk(root):
+                for f in files:
+                    if not f.endswith('.dcm'):
+                        continue
+                    path = os.path.join(dirpath, f)
+                    found.add(path)
+                    stat = os.stat(path)
+                    if known.get(path) != (stat.st_size, stat.st_mtime):
+                        todo.append(path)
+
+        packed = []
+        for root in roots:
+            if os.path.exists(os.path.join(root, STORE_INDEX)):
+                with SeriesStore(root) as store:
+                    for row in store.index_rows(TAGS):
+                        found.add(row[0])
+                        if known.get(row[0]) != row[2:4]:
+                            packed.append(row)
+
+        # Only drop deleted files under the scanned roots
+        roots = tuple(os.path.join(root, '') for root in roots)
+        deleted = [(path,) for path in known if path.startswith(roots) and path not in found]
+
+        rows = []
+        if todo:
+            with METRICS.timer('index_read_seconds'), ProcessPoolExecutor(workers) as executor:
+                rows = [row for row in executor.map(read_header, todo, chunksize=chunksize) if row is not None]
+        METRICS.count('indexed_files_total', len(rows))
+        METRICS.count('indexed_packed_total', len(packed))
+        METRICS.count('index_removed_total', len(deleted))
+        rows += packed
+        with self._conn:
+            self._conn.executemany('DELETE FROM instances WHERE path=?', deleted)
+            self._conn.executemany('INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        print(f'Index: {len(rows)} files added or updated, {len(deleted)} removed')
+        return len(rows)
+
+    def series(self, uids=None, key='series_uid'):
+        ''' Series on disk, optionally only those with the given UIDs.
+        Args:
+            uids: UIDs to look up, all series if None
+            key: column the UIDs are matched on, 'series_uid' or 'study_uid'
+        Return:
+            DataFrame with one row per series directory
+        '''
+        with self._lock:
+            if uids is None:
+                return pd.read_sql_query('SELECT * FROM series', self._conn)
+            uids = list(uids) or [None]
+            frames = []
+            for i in range(0, len(uids), 500):
+                batch = uids[i:i + 500]
+                frames.append(pd.read_sql_query(
+                    f'SELECT * FROM series WHERE {key} IN ({",".join("?" * len(batch))})', self._conn, params=batch
+                ))
+        return pd.concat(frames, ignore_index=True)
+
+    def instance_counts(self, SerInsUIDs):
+        ''' Number of instances on disk per series instance UID.
+        '''
+        df = self.series(SerInsUIDs)
+        return df.groupby('series_uid')['n_instances'].max().to_dict()
+
+    def instance_sizes(self):
+        ''' Mean size of an instance per series description, and over all instances under None.
+        '''
+        with self._lock:
+            sizes = dict(self._conn.execute('SELECT series_description, AVG(size) FROM instances GROUP BY series_description'))
+            mean = self._conn.execute('SELECT AVG(size) FROM instances').fetchone()[0]
+        if mean is not None:
+            sizes[None] = mean
+        return sizes
+
+
+def join_index(df, index):
+    ''' Add the series found on disk to a find_studies output.
+    Series level rows get the instance count and directory of their series,
+    study level rows the number of series and instances of their study.
+    '''
+    if 'SeriesInstanceUID' in df:
+        on_disk = index.series(df['SeriesInstanceUID'].unique())
+        on_disk = on_disk.sort_values('n_instances').drop_duplicates('series_uid', keep='last')
+        on_disk = on_disk[['series_uid', 'n_instances', 'dir']].rename(columns={
+            'series_uid': 'SeriesInstanceUID', 'n_instances': 'InstancesOnDisk', 'dir': 'PathOnDisk'})
+    else:
+        on_disk = index.series(df['StudyInstanceUID'].unique(), key='study_uid')
+        on_disk = on_disk.groupby('study_uid').agg(SeriesOnDisk=('series_uid', 'nunique'), InstancesOnDisk=('n_instances', 'sum'))
+        on_disk = on_disk.reset_index().rename(columns={'study_uid': 'StudyInstanceUID'})
+    df = df.merge(on_disk, how='left')
+    for column in ('SeriesOnDisk', 'InstancesOnDisk'):
+        if column in df:
+            df[column] = df[column].fillna(0).astype(int)
+    return df
+
+
+@click.command()
+@click.option('--dirs', multiple=True, help='The directories to index (OUT_DIR and the output of anonymize_data.py if none).')
+@click.option('--workers', default=None, type=int, help='The number of worker processes for header reads.')
+@instrument('index_data')
+def main(dirs, workers):
+    # Imported here, as importing anonymize_data sets up its de-identification profile
+    from anonymize_data import DSTDIR
+    dirs = dirs or [OUT_DIR, DSTDIR]
+    with MetadataIndex() as index:
+        index.update(dirs, workers=workers)
+        df = index.series()
+        print(f'{len(df)} series of {df.patient_id.nunique()} patients, {df.n_instances.sum()} files')
+
+
+if __name__ == "__main__":
+    start = datetime.now()
+    main(standalone_mode=False)
+    print(f'Running time: {datetime.now() - start}')
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+CHUNK_SIZE = 1024 * 1024  # Chunk size of file hashing (bytes)
+
+
+def file_hash(path):
+    ''' SHA-256 of the content of a file, read in chunks.
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_entry(src, dst):
+    ''' Manifest entry of a processed file: (source, size, mtime, hash, output).
+    '''
+    stat = os.stat(src)
+    return src, stat.st_size, stat.st_mtime, file_hash(src), dst
+
+
+class Manifest:
+    ''' SQLite manifest of processed files.
+
+    Every processed source file is recorded with its size, mtime, content
+    hash, output path and the profile version it was processed with. A file
+    only has to be processed again if it is new, its content changed, its
+    output is missing or the profile version changed.
+    Args:
+        path: SQLite database file
+        profile: version of the processing profile
+    '''
+    def __init__(self, path, profile):
+        self.profile = profile
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                src TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT,
+                dst TEXT, profile TEXT, processed REAL
+            )
+        ''')
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def pending(self, tasks, exists=os.path.exists):
+        ''' Select the tasks whose source file has to be processed.
+        Args:
+            tasks: list of tuples starting with (source, output)
+            exists: whether an output is present, e.g. also in the packs of series_store.py
+        Return:
+            list of the tasks that are new, changed or incomplete
+        '''
+        entries = {row[0]: row[1:] for row in self._conn.execute('SELECT src, size, mtime, sha256, dst, profile FROM files')}
+        todo = []
+        touched = []
+        for task in tasks:
+            src, dst = task[0], task[1]
+            entry = entries.get(src)
+            if entry is None or entry[3] != dst or entry[4] != self.profile or not exists(dst):
+                todo.append(task)
+                continue
+
+            stat = os.stat(src)
+            if stat.st_size != entry[0]:
+                todo.append(task)
+            elif stat.st_mtime != entry[1]:
+                # Touched files are only processed again if their content changed
+                if file_hash(src) != entry[2]:
+                    todo.append(task)
+                else:
+                    touched.append((stat.st_mtime, src))
+
+        if touched:
+            self._conn.executemany('UPDATE files SET mtime=? WHERE src=?', touched)
+            self._conn.commit()
+        return todo
+
+    def record(self, entries):
+        ''' Record processed files in one transaction.
+        Args:
+            entries: list of (source, size, mtime, hash, output)
+        '''
+        now = time.time()
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [entry + (self.profile, now) for entry in entries]
+        )
+        self._conn.commit()
@@ -0,0 +1,185 @@
+import bisect
+import click
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+
+# Parameters
+METRICS_DIR = "../../tmp/dicom/metrics"  # Directory of the metrics summaries of every run
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)  # Upper bounds of the histogram buckets (seconds)
+
+
+class Histogram:
+    ''' Count, sum, minimum, maximum and bucket counts of observed values.
+    '''
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def summary(self):
+        return {
+            'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+            'mean': self.sum / self.count if self.count else None,
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class Metrics:
+    ''' Thread-safe registry of the counters and histograms of a run.
+
+    Metrics are named in the Prometheus style (e.g. http_bytes_total,
+    association_open_seconds) and can carry labels, e.g. the pipeline stage.
+    '''
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        if not labels:
+            return name
+        return name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+    def count(self, name, value=1, **labels):
+        ''' Increase a counter.
+        '''
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        ''' Add a value, e.g. a duration in seconds, to a histogram.
+        '''
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        ''' Observe the duration of a block in a histogram.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def summary(self):
+        with self._lock:
+            return {
+                'start': datetime.fromtimestamp(self.start).isoformat(timespec='seconds'),
+                'elapsed': time.time() - self.start,
+                'counters': dict(self.counters),
+                'histograms': {key: histogram.summary() for key, histogram in self.histograms.items()},
+            }
+
+    def prometheus(self):
+        ''' Summary in the Prometheus text format, e.g. for the textfile collector of the node exporter.
+        '''
+        summary = self.summary()
+        lines = []
+        for key, value in sorted(summary['counters'].items()):
+            lines.append(f'{key} {value}')
+        for key, histogram in sorted(summary['histograms'].items()):
+            name, _, labels = key.partition('{')
+            labels = labels.rstrip('}')
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{name}_bucket{{{labels + "," if labels else ""}{le}}} {cumulative}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{name}_sum{suffix} {histogram["sum"]}')
+            lines.append(f'{name}_count{suffix} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, name, fmt='json', out_dir=METRICS_DIR):
+        ''' Save the summary of the run as JSON or Prometheus text.
+        Return:
+            path of the summary file
+        '''
+        os.makedirs(out_dir, exist_ok=True)
+        stamp = datetime.fromtimestamp(self.start).strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(out_dir, f'{name}-{stamp}.{fmt}')
+        with open(path, 'w') as f:
+            if fmt == 'json':
+                json.dump(self.summary(), f, indent=2)
+            else:
+                f.write(self.prometheus())
+        return path
+
+    def report(self):
+        ''' Print the counters and the mean and maximum of the histograms.
+        '''
+        summary = self.summary()
+        for key, value in sorted(summary['counters'].items()):
+            print(f'{key}: {value}')
+        for key, histogram in sorted(summary['histograms'].items()):
+            print(f"{key}: {histogram['count']} x {histogram['mean']:.4f}s (max {histogram['max']:.4f}s, "
+                  f"total {histogram['sum']:.1f}s)")
+
+
+# Metrics of the process, shared by all modules
+METRICS = Metrics()
+
+
+@contextmanager
+def profile(path=''):
+    ''' Profile a block with cProfile and save the statistics to path (nothing if empty).
+    The statistics can be read with pstats or snakeviz.
+    '''
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        print(f'Saved profile {path}')
+
+
+def instrument(name):
+    ''' Decorator of a click command, adding the --metrics and --profile options.
+    The metrics summary is printed and exported at the end of every run.
+    '''
+    def decorator(command):
+        @click.option('--metrics', 'metrics_format', default='json', type=click.Choice(['json', 'prom', '']),
+                      help=f'The format of the metrics summary saved to {METRICS_DIR} (none if empty).')
+        @click.option('--profile', 'profile_file', default='', type=str,
+                      help='The file the cProfile statistics are saved to (no profiling if empty).')
+        @functools.wraps(command)
+        def wrapper(*args, metrics_format, profile_file, **kwargs):
+            try:
+                with profile(profile_file):
+                    return command(*args, **kwargs)
+            finally:
+                METRICS.report()
+                if metrics_format:
+                    print(f'Saved metrics {METRICS.export(name, metrics_format)}')
+        return wrapper
+    return decorator
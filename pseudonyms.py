@@ -0,0 +1,102 @@
+import hashlib
+import hmac
+import os
+import sqlite3
+import time
+
+# Parameters
+PSEUDONYM_KEY = os.environ.get('PSEUDONYM_KEY', '')  # Secret key of the keyed hash, keep it out of the repository
+LENGTH = 10                                          # Number of hex characters of a pseudonym
+
+
+def pseudonym(patient_id, key=PSEUDONYM_KEY, length=LENGTH):
+    ''' Keyed hash (HMAC-SHA256) of a patient ID, truncated to length hex characters.
+    '''
+    return hmac.new(key.encode(), patient_id.encode(), hashlib.sha256).hexdigest()[:length]
+
+
+def scan_patients(srcdir):
+    ''' List the patient folders of a directory with a single scan.
+    Return:
+        sorted list of (patient folder, patient ID), the ID being the 10-digit folder prefix
+    '''
+    return sorted((entry.name, entry.name[:10]) for entry in os.scandir(srcdir) if entry.is_dir())
+
+
+class PseudonymTable:
+    ''' Persistent, indexed lookup table of patient IDs and their pseudonyms.
+    Args:
+        path: SQLite database file
+        key: secret key of the keyed hash
+        length: number of hex characters of a pseudonym
+    '''
+    def __init__(self, path, key=PSEUDONYM_KEY, length=LENGTH):
+        if not key:
+            print('Warning: no PSEUDONYM_KEY set, pseudonyms can be recomputed from patient IDs')
+        self.key = key
+        self.length = length
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS pseudonyms (
+                patient_id TEXT PRIMARY KEY, pseudonym TEXT NOT NULL UNIQUE, created REAL
+            )
+        ''')
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def register(self, patient_ids):
+        ''' Register patient IDs in one transaction and return their pseudonyms.
+        Patients registered before keep their pseudonym.
+        Raise:
+            ValueError if two patient IDs have the same pseudonym
+        Return:
+            dict of patient ID to pseudonym
+        '''
+        new = {patient_id: pseudonym(patient_id, self.key, self.length) for patient_id in set(patient_ids)}
+        now = time.time()
+        with self._conn:
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS new_pseudonyms (patient_id TEXT PRIMARY KEY, pseudonym TEXT)')
+            self._conn.execute('DELETE FROM new_pseudonyms')
+            self._conn.executemany('INSERT INTO new_pseudonyms VALUES (?, ?)', new.items())
+
+            # Collisions between new patients, or with patients registered before
+            collisions = self._conn.execute('''
+                SELECT n.pseudonym FROM new_pseudonyms n
+                LEFT JOIN pseudonyms p ON p.patient_id = n.patient_id
+                WHERE p.patient_id IS NULL
+                AND (n.pseudonym IN (SELECT pseudonym FROM pseudonyms)
+                     OR n.pseudonym IN (SELECT pseudonym FROM new_pseudonyms GROUP BY pseudonym HAVING COUNT(*) > 1))
+            ''').fetchall()
+            if collisions:
+                raise ValueError(f'Pseudonym collision for {len(collisions)} patients, use a longer pseudonym')
+
+            self._conn.execute('INSERT OR IGNORE INTO pseudonyms SELECT patient_id, pseudonym, ? FROM new_pseudonyms', (now,))
+            rows = self._conn.execute('''
+                SELECT p.patient_id, p.pseudonym FROM pseudonyms p JOIN new_pseudonyms n ON p.patient_id = n.patient_id
+            ''').fetchall()
+        return dict(rows)
+
+    def reidentify(self, pseudonyms):
+        ''' Look up the patient IDs of pseudonyms, for authorized re-identification.
+        Return:
+            dict of pseudonym to patient ID
+        '''
+        pseudonyms = list(pseudonyms)
+        result = {}
+        for i in range(0, len(pseudonyms), 500):
+            batch = pseudonyms[i:i + 500]
+            rows = self._conn.execute(
+                f'SELECT pseudonym, patient_id FROM pseudonyms WHERE pseudonym IN ({",".join("?" * len(batch))})', batch
+            )
+            result.update(rows)
+        return result
@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+import json
+import os
+import sqlite3
+import threading
+import time
+from pydicom.dataset import Dataset
+
+# Parameters
+CACHE_FILE = "../../tmp/dicom/query_cache.sqlite"
+TTL = 24 * 3600     # Time to live of cached responses for recent study dates (seconds)
+FREEZE_DAYS = 30    # Responses for study dates older than this never expire
+
+
+class QueryCache:
+    ''' On-disk cache of C-FIND responses.
+
+    Responses are keyed by query level, study date, patient ID, modality and
+    the full query dataset. Responses for study dates older than freeze_days
+    cannot change anymore and never expire, more recent ones expire after ttl
+    seconds.
+    Args:
+        path: SQLite database file
+        ttl: time to live of responses for recent study dates (seconds)
+        freeze_days: age in days after which responses never expire
+        refresh: ignore cached responses and overwrite them with new ones
+    '''
+    def __init__(self, path=CACHE_FILE, ttl=TTL, freeze_days=FREEZE_DAYS, refresh=False):
+        self.ttl = ttl
+        self.freeze_date = (datetime.now() - timedelta(days=freeze_days)).strftime('%Y%m%d')
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                level TEXT, date TEXT, pid TEXT, modality TEXT, query TEXT,
+                created REAL, identifiers TEXT,
+                PRIMARY KEY (level, date, pid, modality, query)
+            )
+        ''')
+        self._conn.commit()
+
+    @staticmethod
+    def key(ds):
+        ''' Return the cache key of a query dataset.
+        '''
+        query = json.dumps(ds.to_json_dict(), sort_keys=True)
+        return (str(ds.get('QueryRetrieveLevel', '')), str(ds.get('StudyDate', '')),
+                str(ds.get('PatientID', '')), str(ds.get('Modality', '')), query)
+
+    def is_frozen(self, date):
+        ''' Check whether the responses for a study date (or the end of a date range) can still change.
+        '''
+        end = date.split('-')[-1]
+        return len(end) == 8 and end < self.freeze_date
+
+    def get(self, ds):
+        ''' Return the cached identifiers of a query, or None if there are none or they expired.
+        '''
+        if self.refresh:
+            return None
+        key = self.key(ds)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT created, identifiers FROM responses WHERE level=? AND date=? AND pid=? AND modality=? AND query=?',
+                key
+            ).fetchone()
+        if row is None or (not self.is_frozen(key[1]) and time.time() - row[0] > self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [Dataset.from_json(identifier) for identifier in json.loads(row[1])]
+
+    def put(self, ds, identifiers):
+        ''' Store the identifiers returned for a query.
+        '''
+        data = json.dumps([identifier.to_json_dict() for identifier in identifiers])
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                self.key(ds) + (time.time(), data)
+            )
+            self._conn.commit()
+
+    def invalidate(self, date=None, pid=None):
+        ''' Remove cached responses, optionally only for a study date and/or patient ID.
+        '''
+        conditions, params = [], []
+        if date is not None:
+            conditions.append('date=?')
+            params.append(date)
+        if pid is not None:
+            conditions.append('pid=?')
+            params.append(pid)
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        with self._lock:
+            self._conn.execute(f'DELETE FROM responses{where}', params)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def report(self):
+        print(f'Query cache: {self.hits} hits, {self.misses} misses')
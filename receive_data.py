@@ -0,0 +1,183 @@
+import click
+from datetime import datetime
+import os
+import threading
+import time
+from pynetdicom import AE, ALL_TRANSFER_SYNTAXES, evt
+
+from anonymize_data import anonymize_dataset, DSTDIR, PSEUDONYM_FILE, UID_FILE, UID_MAP
+from metrics import instrument, METRICS
+from pseudonyms import PseudonymTable
+from uid_map import UIDTable
+from utils import store_instance, CHUNK_SIZE, OUT_DIR, STORAGE_CLASSES
+
+# Parameters
+RECEIVER_AE_TITLE = ""  # AE title of the receiver, known to the PACS as a C-MOVE destination
+RECEIVER_PORT = 11113   # Port of the receiver, known to the PACS
+MAX_ASSOCIATIONS = 16   # Maximum number of concurrent associations accepted
+FSYNC_BATCH = 0         # Number of files synced to disk at once (0 to leave it to the OS)
+
+
+class SyncBatch:
+    ''' Files written since the last sync, flushed to disk in batches.
+    One batch of fsync calls is much cheaper than an fsync per file, and
+    the files are still on disk once the batch or the association is done.
+    Args:
+        size: number of files per batch, the files are never synced if 0
+    '''
+    def __init__(self, size=FSYNC_BATCH):
+        self.size = size
+        self.paths = []
+        self._lock = threading.Lock()
+
+    def add(self, path):
+        if not self.size:
+            return
+        with self._lock:
+            self.paths.append(path)
+            full = len(self.paths) >= self.size
+        if full:
+            self.sync()
+
+    def sync(self):
+        with self._lock:
+            paths, self.paths = self.paths, []
+        if not paths:
+            return
+        with METRICS.timer('fsync_batch_seconds'):
+            # The files, then their directories so that new entries are on disk too
+            for path in paths + sorted(set(os.path.dirname(path) for path in paths)):
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+
+class Receiver:
+    ''' Storage SCP writing the received instances straight to disk.
+
+    The receiver can be the destination of a C-MOVE, so that the series do
+    not have to be downloaded and unzipped from the archive of the AEM.
+    Each association is handled by its own thread. Instances are written to
+    out_dir/<pid>-<date>/<SeriesUID>/, or de-identified on the fly with the
+    profile of anonymize_data.py and written to
+    out_dir/<pseudonym>/<StudyUID>/<SeriesUID>/ with the new UIDs.
+    Args:
+        ae_title: AE title of the receiver
+        port: port of the receiver
+        out_dir: output directory
+        anonymize: whether to de-identify the instances before writing them
+        fsync_batch: number of files synced to disk at once (0 to leave it to the OS)
+        max_associations: maximum number of concurrent associations
+    '''
+    def __init__(self, ae_title=RECEIVER_AE_TITLE, port=RECEIVER_PORT, out_dir=OUT_DIR, anonymize=False,
+                 fsync_batch=FSYNC_BATCH, max_associations=MAX_ASSOCIATIONS):
+        self.out_dir = out_dir
+        self.anonymize = anonymize
+        self.batch = SyncBatch(fsync_batch)
+        self.pseudonyms = {}
+        self._lock = threading.Lock()
+
+        self.ae = AE(ae_title=ae_title)
+        self.ae.maximum_associations = max_associations
+        # Accept the instances as sent by the PACS, compressed or not
+        for uid in STORAGE_CLASSES:
+            self.ae.add_supported_context(uid, ALL_TRANSFER_SYNTAXES)
+        self.handlers = [(evt.EVT_C_STORE, self.store), (evt.EVT_RELEASED, self.released), (evt.EVT_ABORTED, self.released)]
+        self.port = port
+        self.server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self, block=False):
+        ''' Start listening, in the background unless block is set.
+        '''
+        print(f'Receiving on port {self.port} into {self.out_dir}')
+        self.server = self.ae.start_server(('', self.port), block=block, evt_handlers=self.handlers)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+        self.flush()
+
+    def flush(self):
+        ''' Sync the written files and record the UID mappings of the anonymized instances.
+        '''
+        self.batch.sync()
+        if self.anonymize:
+            mappings = UID_MAP.drain()
+            if mappings:
+                with self._lock, UIDTable(UID_FILE) as uid_table:
+                    uid_table.record(mappings)
+
+    def released(self, event):
+        # Each association is complete on disk once it is released
+        self.flush()
+
+    def pseudonym(self, patient_id):
+        ''' Pseudonym of a patient, registered in the pseudonym table on first use.
+        '''
+        with self._lock:
+            if patient_id not in self.pseudonyms:
+                with PseudonymTable(PSEUDONYM_FILE) as table:
+                    self.pseudonyms.update(table.register([patient_id]))
+            return self.pseudonyms[patient_id]
+
+    def store(self, event):
+        if not self.anonymize:
+            return store_instance(event, self.out_dir, on_write=self.batch.add)
+
+        ds = event.dataset
+        ds.file_meta = event.file_meta
+        # Same patient ID as the 10-digit folder prefix of anonymize_data.py, hence the same pseudonym
+        pid = str(ds.get('PatientID', ''))
+        pid = pid.zfill(10) if pid.isdigit() else pid
+        try:
+            anonymized_id = self.pseudonym(pid)
+            # The associations are de-identified in parallel, UID_MAP records its new mappings thread-safely
+            with METRICS.timer('anonymize_file_seconds'):
+                anonymize_dataset(ds, anonymized_id)
+            target_dir = os.path.join(self.out_dir, anonymized_id, ds.StudyInstanceUID, ds.SeriesInstanceUID)
+            path = os.path.join(target_dir, f'{ds.SOPInstanceUID}.dcm')
+            os.makedirs(target_dir, exist_ok=True)
+            with open(path, 'wb', buffering=CHUNK_SIZE) as f:
+                ds.save_as(f, enforce_file_format=True)
+            METRICS.count('stored_instances_total')
+        except (OSError, ValueError) as e:
+            print(f'Storing {ds.get("SOPInstanceUID", "")} failed: {e}')
+            return 0xA700
+        self.batch.add(path)
+        return 0x0000
+
+
+@click.command()
+@click.option('--ae-title', default=RECEIVER_AE_TITLE, type=str, help='The AE title of the receiver.')
+@click.option('--port', default=RECEIVER_PORT, type=int, help='The port of the receiver.')
+@click.option('--anonymize', is_flag=True, help=f'De-identify the instances on the fly and write them to {DSTDIR}.')
+@click.option('--fsync-batch', default=FSYNC_BATCH, type=int, help='The number of files synced to disk at once (0 to leave it to the OS).')
+@click.option('--max-associations', default=MAX_ASSOCIATIONS, type=int, help='The maximum number of concurrent associations.')
+@instrument('receive_data')
+def main(ae_title, port, anonymize, fsync_batch, max_associations):
+    out_dir = DSTDIR if anonymize else OUT_DIR
+    receiver = Receiver(ae_title, port, out_dir, anonymize, fsync_batch, max_associations)
+    receiver.start()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.stop()
+
+
+if __name__ == "__main__":
+    start = datetime.now()
+    main(standalone_mode=False)
+    print(f'Running time: {datetime.now() - start}')
@@ -1,47 +1,281 @@
+import asyncio
 import click
+from contextlib import nullcontext
 from datetime import datetime
 import pandas as pd
-from utils import retrieve_data, move_data, transfer_data
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelMove
+from async_pipeline import retrieve_plan
+from cohort import read_studies, CohortCursor, CHUNK_ROWS
+from filter_items import compile_series_filter, PROTOCOLS
+from index_data import MetadataIndex
+from metrics import instrument
+from query_cache import QueryCache
+from receive_data import Receiver, RECEIVER_AE_TITLE
+from series_store import SeriesStore, COMPRESSIONS
+from utils import (retrieve_data, move_data, extract_series, get_session, run_pipeline,
+                   ArchiveClient, PACSSessionPool, OUT_DIR)
 
 AEM = ""  
-EXCEL_TAB = "stroke"
+EXCEL_TAB = "stroke"  # Sheet of the input with an Excel file
+MAX_ASSOCIATIONS = 4  # Maximum number of concurrent associations accepted by the PACS
+INSTANCE_SIZE = 512 * 1024  # Estimated size of an instance (bytes) while none is on disk
+
+
+def is_complete(identifier, counts):
+    ''' Whether a series is on disk with all its instances.
+    Series without instance count in the response only have to be on disk.
+    '''
+    n_instances = counts.get(identifier.get('SeriesInstanceUID'), 0)
+    expected = identifier.get('NumberOfSeriesRelatedInstances')
+    return n_instances > 0 and (expected in (None, '') or n_instances >= int(expected))
+
+
+def plan_retrieval(rows, pool, index=None, series_filter=None, workers=1):
+    ''' Query the series of every row and keep the series that have to be retrieved.
+    The series are matched with the series filter and the series already on
+    disk with all their instances, according to the index, are skipped.
+    The rows are queried with up to `workers` sessions of the pool.
+    Return:
+        move plan, a list of (patient ID, study date, study instance UID, series identifiers),
+        and the number of rows whose query failed
+    '''
+    query = lambda session, row: retrieve_data(*row, print_sequences=False, return_response=True, session=session)
+    plan = []
+    seen = set()
+    n_filtered = n_present = n_failed = 0
+    for (patientID, studyDate), response in zip(rows, pool.map(query, rows, workers)):
+        if response is None:
+            print(f'Query failed ({patientID:010d}/{studyDate})')
+            n_failed += 1
+            continue
+        response = [res for res in response or [] if res.get('SeriesInstanceUID') not in seen]
+        seen.update(res.get('SeriesInstanceUID') for res in response)
+        if series_filter is not None:
+            n_series = len(response)
+            response = [res for res in response if series_filter(res.get('SeriesDescription', 'N/A'))]
+            n_filtered += n_series - len(response)
+
+        counts = index.instance_counts(res.get('SeriesInstanceUID') for res in response) if index is not None else {}
+
+        # Group the series by study, so that each study is moved with a single request
+        studies = {}
+        for res in response:
+            if is_complete(res, counts):
+                n_present += 1
+                continue
+            studies.setdefault(res.get('StudyInstanceUID'), []).append(res)
+        for StuInsUID, series in studies.items():
+            plan.append((patientID, studyDate, StuInsUID, series))
+
+    print(f'Plan: {n_filtered} series filtered out, {n_present} series already on disk, {n_failed} failed queries')
+    return plan, n_failed
+
+
+def report_plan(plan, index=None, path='', append=False):
+    ''' Print the series and estimated bytes a move plan transfers, and optionally save it as CSV.
+    The size of a series is its instance count times the mean size of an
+    instance of the same series description on disk.
+    Return:
+        estimated number of bytes
+    '''
+    sizes = index.instance_sizes() if index is not None else {}
+    rows = []
+    for patientID, studyDate, StuInsUID, series in plan:
+        for res in series:
+            description = res.get('SeriesDescription', 'N/A')
+            instances = res.get('NumberOfSeriesRelatedInstances')
+            instances = int(instances) if instances not in (None, '') else None
+            size = sizes.get(description, sizes.get(None, INSTANCE_SIZE))
+            rows.append({
+                'PatientID': f'{patientID:010d}', 'StudyDate': studyDate, 'StudyInstanceUID': StuInsUID,
+                'SeriesInstanceUID': res.get('SeriesInstanceUID'), 'SeriesDescription': description,
+                'Instances': instances, 'Bytes': int(instances * size) if instances is not None else None,
+            })
+    df = pd.DataFrame(rows, columns=['PatientID', 'StudyDate', 'StudyInstanceUID', 'SeriesInstanceUID',
+                                     'SeriesDescription', 'Instances', 'Bytes'])
+
+    n_bytes = int(df['Bytes'].sum())
+    unknown = int(df['Instances'].isna().sum())
+    print(f"Move plan: {len(plan)} studies, {len(df)} series, {int(df['Instances'].sum())} instances, "
+          f"~{n_bytes / 1e9:.2f} GB" + (f' ({unknown} series of unknown size)' if unknown else ''))
+    if path:
+        df.to_csv(path, index=False, mode='a' if append else 'w', header=not append)
+        print(f'Saved {path}')
+    return n_bytes
+
+
+def move_stage(pool, get, client, direct=False, incomplete=None):
+    ''' Move all series of a study from the PACS, to the AEM, or to OUT_DIR with C-GET or the receiver of receive_data.py.
+    The series moved to the AEM are looked up in its archive with a single query.
+    Args:
+        incomplete: list the studies whose move failed for some instances are appended to
+    '''
+    def move(study):
+        patientID, studyDate, StuInsUID, series = study
+        SerInsUIDs = [res.get('SeriesInstanceUID') for res in series]
+        print(f"Transfering {', '.join(res.get('SeriesDescription', 'N/A') for res in series)} ({patientID:010d}/{studyDate})")
+        with pool.session() as session:
+            result = move_data(StuInsUID, SerInsUIDs, AEM=None if get else RECEIVER_AE_TITLE if direct else AEM, session=session)
+        if result is None or result['status'] not in (0x0000, 0xB000):
+            print(f'Move failed ({patientID:010d}/{studyDate})')
+            return
+        if result['failed'] or result['status'] == 0xB000:
+            # The instances that were moved are still transferred, the others on the next run
+            print(f"Move incomplete, {result['failed']} instances failed ({patientID:010d}/{studyDate})")
+            if incomplete is not None:
+                incomplete.append(study[:3])
+        if get or direct:
+            yield from SerInsUIDs
+            return
+
+        fnames = client.find_series(SerInsUIDs, patientID)
+        for SerInsUID in SerInsUIDs:
+            if SerInsUID not in fnames:
+                print(f'{SerInsUID} not found in the archive')
+                continue
+            yield patientID, SerInsUID, studyDate, fnames[SerInsUID]
+    return move
+
+
+def download_stage(client):
+    ''' Download a series from the archive of the AEM as a zip file.
+    '''
+    def download(series):
+        patientID, SerInsUID, studyDate, fname = series
+        tmp_file = client.download(fname)
+        if tmp_file is not None:
+            yield tmp_file, patientID, SerInsUID, studyDate
+    return download
+
+
+def extract(archive):
+    ''' Unzip a downloaded series into OUT_DIR.
+    '''
+    yield extract_series(*archive)
+
+
+def retrieve_series(rows, pool, client, index=None, series_filter=None, get=False, query_workers=1, move_workers=1,
+                    download_workers=2, extract_workers=1, queue_size=8, dry_run=False, plan_file='', use_asyncio=False,
+                    timeout=None, direct=False, append_plan=False):
+    ''' Plan the series to retrieve for the rows and retrieve them.
+    Args:
+        rows: list of (patient ID, study date)
+        pool: PACSSessionPool used for the queries and moves
+        client: ArchiveClient of the AEM, unused with get or direct
+        index: MetadataIndex of OUT_DIR, the series on disk are not skipped if None
+        series_filter: matcher of the series descriptions to retrieve, all series if None
+        get: whether to retrieve the series with C-GET instead of C-MOVE
+        direct: whether to move the series to the receiver of receive_data.py, which has to be running, instead of the AEM
+        use_asyncio: whether to run all studies on one event loop instead of the thread pipeline
+        timeout: time limit of the move and of the download of a series with use_asyncio (seconds)
+        append_plan: whether to append the plan to plan_file, e.g. for the next chunk of the input
+    Return:
+        list of retrieved series (target directories, or series instance UIDs with get or direct),
+        and whether all rows were queried and all instances of the planned series retrieved
+    '''
+    # 2) Retrieve series instance UID and plan the series to move
+    plan, n_failed = plan_retrieval(rows, pool, index, series_filter, query_workers)
+    report_plan(plan, index, plan_file, append_plan)
+    if dry_run:
+        return [], False
+    incomplete = []
+    if use_asyncio:
+        outputs = asyncio.run(retrieve_plan(plan, pool, client, RECEIVER_AE_TITLE if direct else AEM, get, move_workers,
+                                            download_workers, extract_workers, timeout, local=get or direct,
+                                            incomplete=incomplete))
+    else:
+        # 3) Move data from PACS and 4) transfer data (from IDIRRESEARCH to MEDPHYS)
+        # The stages run at the same time, each on its own series
+        stages = [('Move', move_stage(pool, get, client, direct, incomplete), move_workers)]
+        if not (get or direct):
+            stages += [('Download', download_stage(client), download_workers), ('Extract', extract, extract_workers)]
+        outputs = run_pipeline(plan, stages, maxsize=queue_size)
+    # Every series of the plan gives one output, failed moves, downloads and extractions none,
+    # and the partially moved series give their output but are incomplete
+    complete = n_failed == 0 and not incomplete and len(outputs) == sum(len(series) for *_, series in plan)
+    return outputs, complete
 
 
 @click.command()
-@click.option('--file', type=str, required=True, help='The excel file for patient selection or data retrieval.')
-def main(file):
-    # 1) Read data from file
-    df = pd.read_csv(file)
-    #df = pd.read_excel(file, EXCEL_TAB)  
-    print(df.head())
-
-    # 2) Retrieve series instance UID
-    for i, row in df.iterrows():
-        # Get patient study info
-        patientID = int(row['Patient'])
-        studyDate = str(row['MRI_StudyDate'])[:10].replace('-', '')
-        print(i, patientID)
-
-        response = retrieve_data(patientID, studyDate, print_sequences=False, return_response=True)
-
-        # Check retrieved response
-        if len(response) > 0:
-            for j, res in enumerate(response):
-                study_description = res.get('StudyDescription', 'N/A')
-                study_date = res.get('StudyDate')
-                StuInsUID = res.get('StudyInstanceUID')
-                SerInsUID = res.get('SeriesInstanceUID')
-                series_item = res.get('SeriesDescription', 'N/A')
-
-                # 3) Move data from PACS
-                print(f'Transfering {series_item} ({patientID:010d}/{studyDate})')
-                print('='*20)
-                move_data(StuInsUID, SerInsUID, AEM=AEM)
-
-                # 4) Transfer data (from IDIRRESEARCH to MEDPHYS)
-                print('Transferring data ...')
-                print('='*20)
-                transfer_data(patientID, SerInsUID, studyDate)
+@click.option('--file', type=str, required=True, help='The CSV, Excel or Parquet file for patient selection or data retrieval.')
+@click.option('--chunk-rows', default=CHUNK_ROWS, type=int, help='The number of rows of the file read and retrieved at once.')
+@click.option('--resume', is_flag=True, help='Skip the rows of the file retrieved by a previous run.')
+@click.option('--cache/--no-cache', default=True, help='Whether to reuse cached C-FIND responses.')
+@click.option('--refresh', is_flag=True, help='Query the PACS again and refresh the cached responses.')
+@click.option('--get', is_flag=True, help='Retrieve the series with C-GET straight to the output directory instead of C-MOVE.')
+@click.option('--direct', is_flag=True, help='Move the series to a receiver started in this process, which writes them straight to the output directory.')
+@click.option('--fsync-batch', default=0, type=int, help='The number of files the receiver of --direct syncs to disk at once (0 to leave it to the OS).')
+@click.option('--query-workers', default=1, type=int, help='The number of parallel C-FIND queries.')
+@click.option('--move-workers', default=1, type=int, help='The number of parallel C-MOVE/C-GET requests.')
+@click.option('--download-workers', default=2, type=int, help='The number of parallel archive downloads.')
+@click.option('--extract-workers', default=1, type=int, help='The number of parallel archive extractions.')
+@click.option('--queue-size', default=8, type=int, help='The number of items waiting between two stages.')
+@click.option('--skip-existing/--all', default=True, help='Whether to skip the series already in OUT_DIR, according to the index of index_data.py.')
+@click.option('--protocol', default=None, type=click.Choice(PROTOCOLS), help=f'The disease protocol whose series are retrieved with --filter: {PROTOCOLS}.')
+@click.option('--filter', is_flag=True, help='Only retrieve the series of the sequence lists of filter_items.py.')
+@click.option('--dry-run', is_flag=True, help='Only report the series and bytes the move plan would transfer.')
+@click.option('--plan-file', default='', type=str, help='The CSV file the move plan is saved to (not saved if empty).')
+@click.option('--asyncio', 'use_asyncio', is_flag=True, help='Keep all studies in flight on one event loop, limited by the number of workers.')
+@click.option('--series-timeout', default=0, type=float, help='The time limit of the move and download of a series with --asyncio, after which they are aborted (s, none if 0).')
+@click.option('--pack', default='', type=click.Choice([''] + COMPRESSIONS), help='Pack the retrieved series into one zip file each, with this compression (not packed if empty).')
+@instrument('retrieve_data')
+def main(file, chunk_rows, resume, cache, refresh, get, direct, fsync_batch, query_workers, move_workers, download_workers, extract_workers, queue_size, skip_existing,
+         protocol, filter, dry_run, plan_file, use_asyncio, series_timeout, pack):
+    cache = QueryCache(refresh=refresh) if cache else None
+    associations = min(query_workers + move_workers, MAX_ASSOCIATIONS)
+    if get:
+        pool = PACSSessionPool(associations, factory=get_session, cache=cache, out_dir=OUT_DIR)
+    else:
+        pool = PACSSessionPool(associations, cache=cache,
+                               contexts=[StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelMove])
+
+    # The index is brought up to date first, only new files are read
+    index = None
+    if skip_existing:
+        index = MetadataIndex()
+        index.update([OUT_DIR])
+
+    client = ArchiveClient(pool_size=download_workers + move_workers)
+    # The moves of --direct end once the receiver has written all instances
+    receiver = Receiver(out_dir=OUT_DIR, fsync_batch=fsync_batch) if direct and not dry_run else nullcontext()
+    cursor = CohortCursor()
+    start_row = cursor.get(file) if resume else 0
+    if start_row:
+        print(f'Resuming after row {start_row}')
+    start = datetime.now()
+    outputs = []
+    complete = not dry_run
+    with pool, client, receiver, cursor:
+        # 1) Read data from file, one chunk of rows at a time
+        # The cursor is moved as long as all studies of the chunks so far were retrieved,
+        # so that a resumed run retries the first chunk with a failure and all after it
+        for i, (n_rows, rows) in enumerate(read_studies(file, chunk_rows, EXCEL_TAB, start_row)):
+            chunk_outputs, chunk_complete = retrieve_series(
+                rows, pool, client, index, compile_series_filter(protocol) if filter else None, get, query_workers,
+                move_workers, download_workers, extract_workers, queue_size, dry_run, plan_file, use_asyncio,
+                series_timeout or None, direct, i > 0)
+            outputs += chunk_outputs
+            if complete and not chunk_complete:
+                print(f'Some studies of rows {start_row}-{n_rows} failed, --resume restarts after row {start_row}')
+            complete = complete and chunk_complete
+            if complete:
+                cursor.set(file, n_rows)
+            start_row = n_rows
+        pool.report()
+    if not dry_run:
+        minutes = (datetime.now() - start).total_seconds() / 60
+        print(f'{len(outputs)} series, {len(outputs) / minutes:.1f} series/min')
+
+    # Pack the new series, the packed instances stay in the index
+    if pack and not dry_run:
+        with SeriesStore(OUT_DIR, pack) as store:
+            store.pack()
+
+    # Add the new series to the index
+    if index is not None:
+        if not dry_run:
+            index.update([OUT_DIR])
+        index.close()
 
 
 if __name__ == "__main__":
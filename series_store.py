@@ -0,0 +1,235 @@
+import click
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import hashlib
+import io
+import os
+import pandas as pd
+import pydicom
+from pydicom.uid import RLELossless
+import shutil
+import sqlite3
+import threading
+import time
+import warnings
+import zipfile
+
+from metrics import instrument, METRICS
+from utils import OUT_DIR
+
+# Parameters
+STORE_INDEX = "series_store.sqlite"  # Header index of the packed instances, in the root directory of a store
+PACK_SUFFIX = ".zip"                 # A series directory <dir> is packed into <dir>.zip
+COMPRESSIONS = ['none', 'deflate', 'rle']
+TAGS = ['PatientID', 'StudyDate', 'StudyInstanceUID', 'SeriesInstanceUID', 'SeriesDescription', 'SOPInstanceUID',
+        'InstanceNumber']
+
+
+def encode_instance(data, compression='none'):
+    ''' Header of a dicom file and the bytes it is packed as.
+    With rle, uncompressed pixel data is compressed with the RLE Lossless
+    transfer syntax, the other files are packed unchanged.
+    Return:
+        (dataset, packed bytes)
+    '''
+    if compression != 'rle':
+        return pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True), data
+    ds = pydicom.dcmread(io.BytesIO(data))
+    if 'PixelData' not in ds or ds.file_meta.TransferSyntaxUID.is_compressed:
+        return ds, data
+    ds.compress(RLELossless)
+    buffer = io.BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    return ds, buffer.getvalue()
+
+
+def header_row(name, sha256, size, info, ds):
+    return (name, sha256, size, info.compress_size, str(ds.file_meta.get('TransferSyntaxUID', ''))) + \
+        tuple(str(ds.get(tag, '')) for tag in TAGS)
+
+
+def pack_series(series_dir, known, compression='none'):
+    ''' Append the dicom files of a series directory to the zip file of the series.
+    Files whose content hash is already in the pack are skipped, so that a
+    rerun does not pack an instance twice. Members of an interrupted run that
+    are missing from the header index are indexed again.
+    Args:
+        series_dir: directory of the dicom files, packed into series_dir.zip
+        known: dict of member name to content hash of the packed instances in the header index
+        compression: 'none', 'deflate' (zip deflate of the files) or 'rle' (RLE Lossless pixel data)
+    Return:
+        (header index rows of the new members, files now in the pack, number of duplicate files)
+    '''
+    hashes = set(known.values())
+    rows = []
+    files = []
+    n_duplicates = 0
+    compress_type = zipfile.ZIP_DEFLATED if compression == 'deflate' else zipfile.ZIP_STORED
+    with zipfile.ZipFile(series_dir + PACK_SUFFIX, 'a', compress_type) as zf:
+        for name in set(zf.namelist()) - set(known):
+            with zf.open(name) as f:
+                data = f.read()
+            rows.append(header_row(name, hashlib.sha256(data).hexdigest(), len(data), zf.getinfo(name),
+                                   pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True)))
+            hashes.add(rows[-1][1])
+
+        for entry in sorted(os.scandir(series_dir), key=lambda entry: entry.name):
+            if not (entry.name.endswith('.dcm') and entry.is_file()):
+                continue
+            with open(entry.path, 'rb') as f:
+                data = f.read()
+            sha256 = hashlib.sha256(data).hexdigest()
+            files.append(entry.path)
+            if sha256 in hashes:
+                n_duplicates += 1
+                continue
+            ds, packed = encode_instance(data, compression)
+            # A changed instance is appended again, the last member of a name is the one read
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                zf.writestr(entry.name, packed)
+            hashes.add(sha256)
+            rows.append(header_row(entry.name, sha256, len(data), zf.getinfo(entry.name), ds))
+    return rows, files, n_duplicates
+
+
+class SeriesStore:
+    ''' Series packed into one zip file each, with a SQLite header index of their instances.
+
+    A series directory of loose dicom files, e.g. OUT_DIR/<pid>-<date>/<SeriesUID>/,
+    is packed into <SeriesUID>.zip next to it, and its files are removed.
+    Members are stored uncompressed by default, so that an instance is read
+    straight from the pack. The header index has the hash, sizes, transfer
+    syntax and main tags of every instance, so that the instances are found
+    without opening the packs, and identical instances are only packed once.
+    Args:
+        root: directory of the series directories and of the header index
+        compression: 'none', 'deflate' or 'rle', for the instances packed from now on
+    '''
+    def __init__(self, root, compression='none'):
+        self.root = root
+        self.compression = compression
+        os.makedirs(root, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(root, STORE_INDEX), check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.executescript(f'''
+            CREATE TABLE IF NOT EXISTS instances (
+                series_dir TEXT, member TEXT, sha256 TEXT, size INTEGER, stored_size INTEGER, transfer_syntax TEXT,
+                {', '.join(f'{tag} TEXT' for tag in TAGS)}, packed REAL,
+                PRIMARY KEY (series_dir, member)
+            );
+            CREATE INDEX IF NOT EXISTS instances_series ON instances (SeriesInstanceUID);
+        ''')
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def series_dirs(self):
+        ''' Directories under the root with loose dicom files.
+        '''
+        return [dirpath for dirpath, _, files in os.walk(self.root) if any(f.endswith('.dcm') for f in files)]
+
+    def pack(self, series_dirs=None, workers=None, remove=True):
+        ''' Pack series directories, each in its own worker process.
+        The files are removed once their pack and header index are written,
+        and the series directories once they are empty.
+        Args:
+            series_dirs: directories to pack, all series directories under the root if None
+            remove: whether to remove the packed files
+        Return:
+            number of files packed, including duplicates
+        '''
+        series_dirs = self.series_dirs() if series_dirs is None else list(series_dirs)
+        keys = [os.path.relpath(series_dir, self.root) for series_dir in series_dirs]
+        known = [dict(self._conn.execute('SELECT member, sha256 FROM instances WHERE series_dir=?', (key,)))
+                 for key in keys]
+        n_files = 0
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(pack_series, series_dir, members, self.compression)
+                       for series_dir, members in zip(series_dirs, known)]
+            for key, series_dir, future in zip(keys, series_dirs, futures):
+                rows, files, n_duplicates = future.result()
+                now = time.time()
+                with self._lock, self._conn:
+                    self._conn.executemany(
+                        f'INSERT OR REPLACE INTO instances VALUES ({",".join("?" * (len(TAGS) + 7))})',
+                        [(key,) + row + (now,) for row in rows]
+                    )
+                METRICS.count('packed_instances_total', len(rows))
+                METRICS.count('packed_duplicates_total', n_duplicates)
+                METRICS.count('packed_bytes_total', sum(row[3] for row in rows))
+                n_files += len(files)
+                if remove:
+                    for path in files:
+                        os.remove(path)
+                    if not os.listdir(series_dir):
+                        shutil.rmtree(series_dir)
+        print(f'Packed {n_files} files of {len(series_dirs)} series into {self.root}')
+        return n_files
+
+    def members(self):
+        ''' Paths of all packed instances, as the loose files they were packed from.
+        '''
+        with self._lock:
+            return {os.path.join(self.root, series_dir, member)
+                    for series_dir, member in self._conn.execute('SELECT series_dir, member FROM instances')}
+
+    def instances(self, SerInsUIDs=None):
+        ''' Header index of the packed instances, optionally only those of the given series instance UIDs.
+        Return:
+            DataFrame with one row per instance
+        '''
+        with self._lock:
+            if SerInsUIDs is None:
+                return pd.read_sql_query('SELECT * FROM instances', self._conn)
+            SerInsUIDs = list(SerInsUIDs)
+            return pd.read_sql_query(
+                f'SELECT * FROM instances WHERE SeriesInstanceUID IN ({",".join("?" * len(SerInsUIDs))})',
+                self._conn, params=SerInsUIDs
+            )
+
+    def read(self, path, **kwargs):
+        ''' Read a packed instance, without unpacking the other instances of its series.
+        Args:
+            path: path of the loose file the instance was packed from
+            kwargs: keyword arguments of pydicom.dcmread, e.g. stop_before_pixels
+        '''
+        with zipfile.ZipFile(os.path.dirname(path) + PACK_SUFFIX) as zf, zf.open(os.path.basename(path)) as f:
+            return pydicom.dcmread(f, **kwargs)
+
+    def index_rows(self, tags):
+        ''' Packed instances as rows of the index of index_data.py: (path, directory, size, mtime, *tags).
+        The directory is the series directory the instances were packed from.
+        '''
+        with self._lock:
+            rows = self._conn.execute(f'SELECT series_dir, member, size, packed, {", ".join(tags)} FROM instances').fetchall()
+        return [(os.path.join(self.root, series_dir, member), os.path.join(self.root, series_dir), size, packed) + tuple(values)
+                for series_dir, member, size, packed, *values in rows]
+
+
+@click.command()
+@click.option('--dirs', multiple=True, default=[OUT_DIR], help='The root directories whose series are packed, e.g. the output of anonymize_data.py.')
+@click.option('--compression', default='none', type=click.Choice(COMPRESSIONS), help='The compression of the packed instances.')
+@click.option('--keep', is_flag=True, help='Keep the packed files.')
+@click.option('--workers', default=None, type=int, help='The number of worker processes.')
+@instrument('series_store')
+def main(dirs, compression, keep, workers):
+    for root in dirs:
+        with SeriesStore(root, compression) as store:
+            store.pack(workers=workers, remove=not keep)
+            df = store.instances()
+            print(f'{df.SeriesInstanceUID.nunique()} series, {len(df)} instances, '
+                  f'{df["size"].sum() / 1e9:.2f} GB packed into {df.stored_size.sum() / 1e9:.2f} GB')
+
+
+if __name__ == "__main__":
+    start = datetime.now()
+    main(standalone_mode=False)
+    print(f'Running time: {datetime.now() - start}')
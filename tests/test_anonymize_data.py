@@ -0,0 +1,68 @@
+import os
+import numpy as np
+import pydicom
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless
+import pytest
+
+import anonymize_data
+import benchmark
+
+PIXELS = np.arange(64 * 64, dtype=np.uint16).tobytes()
+
+
+def write_instance(path, transfer_syntax, trailing=False):
+    ''' Write an instance of the benchmark corpus, optionally with private elements after the pixel data.
+    '''
+    ds = benchmark.make_instance(benchmark.make_corpus(1, 1, 1)[0], 1, PIXELS)
+    ds.InstitutionName = 'HOSPITAL'
+    if transfer_syntax == RLELossless:
+        ds.compress(RLELossless)
+    else:
+        ds.file_meta.TransferSyntaxUID = transfer_syntax
+    if trailing:
+        ds.add_new(0x7FE10010, 'LO', 'SECRET CREATOR')
+        ds.add_new(0x7FE11010, 'LO', 'SECRET PAYLOAD')
+    ds.save_as(path, enforce_file_format=True)
+    return path
+
+
+@pytest.mark.parametrize('transfer_syntax', [ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless])
+@pytest.mark.parametrize('trailing', [False, True])
+def test_fast_output_matches_full_output(tmp_path, transfer_syntax, trailing):
+    src = write_instance(str(tmp_path / 'src.dcm'), transfer_syntax, trailing)
+    anonymize_data.anonymize_dicom(src, str(tmp_path / 'full.dcm'), '0123456789')
+    anonymize_data.anonymize_dicom_header(src, str(tmp_path / 'fast.dcm'), '0123456789')
+
+    full = pydicom.dcmread(tmp_path / 'full.dcm')
+    fast = pydicom.dcmread(tmp_path / 'fast.dcm')
+    assert fast.PixelData == full.PixelData == pydicom.dcmread(src).PixelData
+    del fast.PixelData, full.PixelData
+    assert fast == full
+    assert fast.file_meta == full.file_meta
+    assert (tmp_path / 'fast.dcm').read_bytes() == (tmp_path / 'full.dcm').read_bytes()
+
+    # Nothing after the pixel data is copied without being de-identified
+    assert b'SECRET' not in (tmp_path / 'fast.dcm').read_bytes()
+    assert fast.PatientID == '0123456789'
+    assert 'InstitutionName' not in fast
+
+
+def test_output_paths_use_the_new_uids(tmp_path, monkeypatch):
+    # Source folders named after the original UIDs, as written by retrieve_data.py
+    monkeypatch.setattr(anonymize_data, 'SRCDIR', str(tmp_path / 'src'))
+    monkeypatch.setattr(anonymize_data, 'DSTDIR', str(tmp_path / 'dst'))
+    series = benchmark.make_corpus(1, 1, 1)[0]
+    series_dir = tmp_path / 'src' / '0000001000-20240301' / series.StudyInstanceUID / series.SeriesInstanceUID
+    series_dir.mkdir(parents=True)
+    src = write_instance(str(series_dir / f'{series.SeriesInstanceUID}.1.dcm'), ExplicitVRLittleEndian)
+
+    [(dicom_file, output_file, _)] = anonymize_data.list_dicom_files('0000001000-20240301', '0123456789')
+    assert dicom_file == src
+    assert '1.2.826.0.1.3680043.10.1' not in output_file
+
+    # Same layout as receive_data.py --anonymize: <pseudonym>/<new StudyUID>/<new SeriesUID>/<new SOPUID>.dcm
+    os.makedirs(os.path.dirname(output_file))
+    anonymize_data.anonymize_dicom_header(dicom_file, output_file, '0123456789')
+    ds = pydicom.dcmread(output_file)
+    assert output_file == os.path.join(str(tmp_path / 'dst'), '0123456789', ds.StudyInstanceUID, ds.SeriesInstanceUID,
+                                       f'{ds.SOPInstanceUID}.dcm')
@@ -0,0 +1,75 @@
+import zipfile
+import pytest
+import requests
+
+import benchmark
+import utils
+from utils import ArchiveClient, BATCH_SIZE
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    # More series than one /tools/find batch
+    return benchmark.make_corpus(BATCH_SIZE // 3 + 2, 3, 2)
+
+
+@pytest.fixture
+def archive(corpus):
+    archive = benchmark.StandInArchive(corpus, bytes(64 * 64 * 2), port=0)
+    yield archive
+    archive.stop()
+
+
+@pytest.fixture
+def client(archive, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'TMP_DIR', str(tmp_path))
+    with ArchiveClient(url=f'http://{benchmark.HOST}:{archive.server.server_address[1]}', backoff=0) as client:
+        yield client
+
+
+def test_find_series_batches(archive, client, corpus):
+    uids = [ds.SeriesInstanceUID for ds in corpus]
+    assert len(uids) > BATCH_SIZE
+    ids = client.find_series(uids + ['1.2.3.999'])
+    assert ids == {uid: uid for uid in uids}
+    assert archive.n_requests == len(uids) // BATCH_SIZE + 1
+
+
+def test_find_series_retries_unavailable(archive, client, corpus):
+    archive.errors = 2
+    uid = corpus[0].SeriesInstanceUID
+    assert client.find_series([uid]) == {uid: uid}
+    assert archive.n_requests == 3
+
+
+def test_find_series_gives_up(archive, client, corpus):
+    # The last 503 is returned after the retries, not raised
+    archive.errors = 10
+    assert client.find_series([corpus[0].SeriesInstanceUID]) == {}
+    assert archive.n_requests == 4
+
+
+def test_download_streams_chunks(archive, client, corpus, monkeypatch):
+    chunks = []
+    iter_content = requests.Response.iter_content
+
+    def spy(self, chunk_size=1, decode_unicode=False):
+        for chunk in iter_content(self, chunk_size, decode_unicode):
+            chunks.append(len(chunk))
+            yield chunk
+    monkeypatch.setattr(requests.Response, 'iter_content', spy)
+    monkeypatch.setattr(utils, 'CHUNK_SIZE', 1024)
+
+    archive.errors = 1
+    series = corpus[0]
+    path = client.download(series.SeriesInstanceUID)
+    with open(path, 'rb') as f:
+        assert f.read() == archive.series_zip(series)
+    with zipfile.ZipFile(path) as zip_ref:
+        assert len(zip_ref.namelist()) == int(series.NumberOfSeriesRelatedInstances)
+    assert len(chunks) > 1 and max(chunks) <= 1024
+
+
+def test_download_unavailable(archive, client, corpus):
+    archive.errors = 10
+    assert client.download(corpus[0].SeriesInstanceUID) is None
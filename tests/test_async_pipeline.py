@@ -0,0 +1,53 @@
+import asyncio
+import time
+import pytest
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelMove
+
+import async_pipeline
+import benchmark
+import utils
+from utils import ArchiveClient, PACSSessionPool
+
+N_STUDIES = 3
+
+
+@pytest.fixture
+def servers(request):
+    corpus = benchmark.make_corpus(N_STUDIES, 1, 2)
+    store = benchmark.StandInStore(port=0)
+    destinations = {benchmark.STORE_AE_TITLE: (benchmark.HOST, store.server.server_address[1])}
+    pacs = benchmark.StandInPACS(corpus, bytes(16 * 16 * 2), latency=request.param, port=0, destinations=destinations)
+    archive = benchmark.StandInArchive(corpus, bytes(16 * 16 * 2), port=0)
+    yield corpus, pacs, archive
+    for server in (pacs, store, archive):
+        server.stop()
+
+
+def retrieve(corpus, pacs, archive, tmp_path, monkeypatch, timeout):
+    ''' Run retrieve_plan over all studies of the corpus and return (series retrieved, seconds).
+    '''
+    monkeypatch.setattr(utils, 'OUT_DIR', str(tmp_path / 'out'))
+    monkeypatch.setattr(utils, 'TMP_DIR', str(tmp_path))
+    plan = [(int(ds.PatientID), ds.StudyDate, ds.StudyInstanceUID, [{'SeriesInstanceUID': ds.SeriesInstanceUID}])
+            for ds in corpus]
+    pool = PACSSessionPool(1, ae_title=benchmark.AE_TITLE, addr=benchmark.HOST, port=pacs.server.server_address[1],
+                           contexts=[StudyRootQueryRetrieveInformationModelMove])
+    client = ArchiveClient(url=f'http://{benchmark.HOST}:{archive.server.server_address[1]}')
+    start = time.perf_counter()
+    with pool, client:
+        outputs = asyncio.run(async_pipeline.retrieve_plan(plan, pool, client, benchmark.STORE_AE_TITLE, timeout=timeout))
+    return outputs, time.perf_counter() - start
+
+
+@pytest.mark.parametrize('servers', [0.], indirect=True)
+def test_retrieve_plan(servers, tmp_path, monkeypatch):
+    outputs, _ = retrieve(*servers, tmp_path, monkeypatch, timeout=10)
+    assert len(outputs) == N_STUDIES
+
+
+@pytest.mark.parametrize('servers', [0.5], indirect=True)
+def test_move_timeout_bounds_the_run(servers, tmp_path, monkeypatch):
+    # The moves are aborted instead of waiting for the PACS or the DIMSE timeout of the association
+    outputs, seconds = retrieve(*servers, tmp_path, monkeypatch, timeout=0.1)
+    assert outputs == []
+    assert seconds < 0.5 * N_STUDIES
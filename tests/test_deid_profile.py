@@ -0,0 +1,91 @@
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+import pytest
+
+from deid_profile import CompiledProfile, BLANK, HASH, REMOVE, REPLACE, SHIFT, UID
+from uid_map import UIDMap
+
+VALUES = {'PatientID': '0123456789', 'PatientName': 'ANONYMIZED'}
+
+
+def make_dataset():
+    ''' Header with identifying elements at the top level, in nested sequences and in private tags.
+    '''
+    referenced = Dataset()
+    referenced.ReferencedSOPInstanceUID = '1.2.3.4.5'
+    referenced.InstitutionName = 'HOSPITAL'
+    referenced.add_new(0x00091001, 'LO', 'PRIVATE IN SEQUENCE')
+    nested = Dataset()
+    nested.ReferencedSOPSequence = Sequence([referenced])
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPInstanceUID = '1.2.3.4.6'
+    ds.PatientName = 'DOE^JOHN'
+    ds.PatientBirthDate = '19700101'
+    ds.StudyInstanceUID = '1.2.3'
+    ds.SeriesInstanceUID = '1.2.3.4'
+    ds.SOPInstanceUID = '1.2.3.4.6'
+    ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    ds.Modality = 'MR'
+    ds.add_new(0x00291010, 'OB', b'SECRET')
+    ds.ReferencedSeriesSequence = Sequence([nested])
+    return ds
+
+
+def test_apply_walks_sequences_and_removes_private_tags():
+    uid_map = UIDMap(salt='salt')
+    ds = make_dataset()
+    CompiledProfile(uid_map=uid_map).apply(ds, VALUES)
+
+    # REPLACE sets the values, and adds the missing PatientID
+    assert ds.PatientID == '0123456789'
+    assert ds.PatientName == 'ANONYMIZED'
+    assert 'PatientBirthDate' not in ds
+    assert ds.Modality == 'MR'
+    assert ds.SOPClassUID == '1.2.840.10008.5.1.4.1.1.4'
+
+    # Private tags and removed elements are gone at every level
+    referenced = ds.ReferencedSeriesSequence[0].ReferencedSOPSequence[0]
+    assert not any(elem.tag.is_private for elem in ds.iterall())
+    assert 'InstitutionName' not in referenced
+
+    # UIDs are remapped in sequences as well, consistently with the top level
+    assert ds.SOPInstanceUID == uid_map.map('1.2.3.4.6') != '1.2.3.4.6'
+    assert referenced.ReferencedSOPInstanceUID == uid_map.map('1.2.3.4.5')
+
+
+def test_file_meta_uids_follow_the_dataset():
+    uid_map = UIDMap(salt='salt')
+    ds = make_dataset()
+    CompiledProfile(uid_map=uid_map).apply(ds, VALUES)
+    uid_map.remap(ds.file_meta)
+    assert ds.file_meta.MediaStorageSOPInstanceUID == ds.SOPInstanceUID
+
+
+def test_actions():
+    ds = Dataset()
+    ds.PatientID = '123'
+    ds.AccessionNumber = 'A1'
+    ds.StudyID = 'S1'
+    ds.StudyDate = '20240301'
+    ds.AcquisitionDateTime = '20240301120000'
+    profile = CompiledProfile({'PatientID': REPLACE, 'AccessionNumber': HASH, 'StudyID': BLANK, 'StudyDate': SHIFT,
+                               'AcquisitionDateTime': SHIFT, 'PatientName': REMOVE}, salt='salt', date_shift=-1)
+    profile.apply(ds)
+
+    # REPLACE without a value removes the element
+    assert 'PatientID' not in ds
+    assert ds.AccessionNumber != 'A1' and len(ds.AccessionNumber) == 16
+    assert ds.StudyID == ''
+    assert ds.StudyDate == '20240229'
+    assert ds.AcquisitionDateTime == '20240229120000'
+
+
+def test_uid_actions_require_a_uid_map():
+    with pytest.raises(ValueError):
+        CompiledProfile()
+    with pytest.raises(ValueError):
+        CompiledProfile({'NotAKeyword': REMOVE})
+    CompiledProfile({'StudyInstanceUID': REMOVE})
+    CompiledProfile({'StudyInstanceUID': UID}, uid_map=UIDMap())
@@ -0,0 +1,56 @@
+from click.testing import CliRunner
+import pytest
+
+import benchmark
+import find_studies
+
+N_DAYS = 12
+
+
+@pytest.fixture(scope='module')
+def pacs():
+    pacs = benchmark.StandInPACS(benchmark.make_corpus(N_DAYS, 3, 1), bytes(16), latency=0.01, port=0)
+    yield pacs
+    pacs.stop()
+
+
+def sweep(pacs, work_dir, monkeypatch, level, **kwargs):
+    ''' Run call_PACS over the corpus in work_dir and return the output file content.
+    '''
+    monkeypatch.setattr(find_studies, 'AEC', {'ip': benchmark.HOST, 'port': pacs.server.server_address[1]})
+    monkeypatch.setattr(find_studies, 'AE_TITLE', benchmark.AE_TITLE)
+    work_dir.mkdir()
+    monkeypatch.chdir(work_dir)
+    find_studies.call_PACS(benchmark.START_DATE, N_DAYS, level, '', None, False, export='', resume=False, **kwargs)
+    with open(work_dir / f'studies_available-None-{level}-{benchmark.START_DATE}-{N_DAYS}.csv') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('level', ['study', 'series'])
+@pytest.mark.parametrize('window', [1, 5])
+def test_parallel_output_matches_serial(pacs, tmp_path, monkeypatch, level, window):
+    serial = sweep(pacs, tmp_path / 'serial', monkeypatch, level, workers=1, window=window)
+    parallel = sweep(pacs, tmp_path / 'parallel', monkeypatch, level, workers=4, window=window)
+    assert serial.count('\n') > 1
+    assert parallel == serial
+
+
+def test_split_windows_match_daily_queries(pacs, tmp_path, monkeypatch):
+    # Windows reaching the response limit are split until no study is dropped
+    daily = sweep(pacs, tmp_path / 'daily', monkeypatch, 'series', workers=2, window=1)
+    split = sweep(pacs, tmp_path / 'split', monkeypatch, 'series', workers=2, window=N_DAYS, limit=4)
+    assert split == daily
+
+
+def test_protocol_is_only_checked_with_filter(monkeypatch):
+    # The series lists of an unknown protocol cannot be matched
+    with pytest.raises(ValueError):
+        find_studies.call_PACS(benchmark.START_DATE, 1, 'series', '', 'epilepsy', True)
+
+    # Without --filter the protocol only names the output file
+    calls = []
+    monkeypatch.setattr(find_studies, 'call_PACS', lambda *args: calls.append(args))
+    runner = CliRunner()
+    result = runner.invoke(find_studies.main, ['--protocol', 'epilepsy', '--no-cache'])
+    assert result.exit_code == 0, result.output
+    assert calls[0][4] == 'epilepsy'
@@ -0,0 +1,30 @@
+import os
+
+from manifest import file_entry, Manifest
+
+
+def test_manifest_pending(tmp_path):
+    src, dst = tmp_path / 'src.dcm', tmp_path / 'dst.dcm'
+    src.write_bytes(b'1')
+    dst.write_bytes(b'')
+    tasks = [(str(src), str(dst), '0123456789')]
+    with Manifest(str(tmp_path / 'manifest.sqlite'), '1') as manifest:
+        assert manifest.pending(tasks) == tasks
+        manifest.record([file_entry(str(src), str(dst))])
+        assert manifest.pending(tasks) == []
+
+        # Touched but unchanged files are skipped
+        os.utime(src, (0, 0))
+        assert manifest.pending(tasks) == []
+
+        # Changed content, or a missing output
+        src.write_bytes(b'2')
+        assert manifest.pending(tasks) == tasks
+        manifest.record([file_entry(str(src), str(dst))])
+        dst.unlink()
+        assert manifest.pending(tasks) == tasks
+
+    # Another profile version processes all files again
+    dst.write_bytes(b'')
+    with Manifest(str(tmp_path / 'manifest.sqlite'), '2') as manifest:
+        assert manifest.pending(tasks) == tasks
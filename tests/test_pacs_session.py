@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+import pytest
+
+import benchmark
+from find_studies import build_query
+from utils import PACSSession
+
+N_DAYS = 10
+
+
+@pytest.fixture
+def pacs():
+    pacs = benchmark.StandInPACS(benchmark.make_corpus(N_DAYS, 1, 1), bytes(16), port=0)
+    yield pacs
+    pacs.stop()
+
+
+@pytest.fixture
+def session(pacs):
+    with PACSSession(ae_title=benchmark.AE_TITLE, addr=benchmark.HOST, port=pacs.server.server_address[1]) as session:
+        yield session
+
+
+def days(n):
+    start = datetime.strptime(benchmark.START_DATE, '%Y%m%d')
+    return [(start - timedelta(days=i)).strftime('%Y%m%d') for i in range(n)]
+
+
+def test_one_association_serves_all_days(pacs, session):
+    for day in days(N_DAYS):
+        assert len(session.find(build_query(day, 'study', ''))) == 1
+    assert session.n_queries == N_DAYS
+    assert session.n_associations == 1
+    assert pacs.n_queries == N_DAYS
+
+
+def test_reconnect_after_the_pacs_aborts(pacs, session):
+    first, second = days(2)
+    assert len(session.find(build_query(first, 'study', ''))) == 1
+    assert session.is_established
+
+    for assoc in pacs.server.active_associations:
+        assoc.abort()
+
+    # The dropped association is noticed when opening it or when sending the query, and opened again
+    assert len(session.find(build_query(second, 'study', ''))) == 1
+    assert session.n_associations == 2
+    assert session.is_established
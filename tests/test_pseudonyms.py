@@ -0,0 +1,31 @@
+import pytest
+
+from pseudonyms import pseudonym, PseudonymTable
+
+
+def test_register_keeps_pseudonyms(tmp_path):
+    path = str(tmp_path / 'pseudonyms.sqlite')
+    with PseudonymTable(path, key='key') as table:
+        first = table.register(['0000001000', '0000001001'])
+    assert first == {patient_id: pseudonym(patient_id, 'key') for patient_id in first}
+
+    # Patients registered before keep their pseudonym, even with another key
+    with PseudonymTable(path, key='other') as table:
+        assert table.register(['0000001000'])['0000001000'] == first['0000001000']
+        assert table.reidentify(first.values()) == {value: key for key, value in first.items()}
+
+
+def test_register_detects_collisions(tmp_path):
+    # 1 hex character: 17 patients cannot have distinct pseudonyms
+    patient_ids = [f'{i:010d}' for i in range(17)]
+    with PseudonymTable(str(tmp_path / 'new.sqlite'), key='key', length=1) as table:
+        with pytest.raises(ValueError):
+            table.register(patient_ids)
+
+    # A new patient colliding with one registered before
+    with PseudonymTable(str(tmp_path / 'registered.sqlite'), key='key', length=1) as table:
+        registered = table.register(patient_ids[:1])
+        colliding = next(p for p in patient_ids[1:] if pseudonym(p, 'key', 1) == registered[patient_ids[0]])
+        with pytest.raises(ValueError):
+            table.register([colliding])
+        assert table.register(patient_ids[:1]) == registered
@@ -0,0 +1,23 @@
+import pytest
+
+import async_pipeline
+import benchmark
+import retrieve_data
+from utils import PACSSessionPool
+
+PLAN = [(1000, '20240301', '1.2.3', [{'SeriesInstanceUID': '1.2.3.1'}, {'SeriesInstanceUID': '1.2.3.2'}])]
+
+
+@pytest.mark.parametrize('use_asyncio', [False, True])
+@pytest.mark.parametrize('status, failed, complete', [(0x0000, 0, True), (0xB000, 3, False), (0xA702, 5, False)])
+def test_partial_moves_are_incomplete(monkeypatch, use_asyncio, status, failed, complete):
+    # A move with failed sub-operations keeps its series, but the chunk is not complete
+    result = {'status': status, 'completed': 10, 'failed': failed, 'warning': 0, 'remaining': 0}
+    monkeypatch.setattr(retrieve_data, 'plan_retrieval', lambda *args: (PLAN, 0))
+    for module in (retrieve_data, async_pipeline):
+        monkeypatch.setattr(module, 'move_data', lambda *args, **kwargs: result)
+    with PACSSessionPool(1, ae_title=benchmark.AE_TITLE) as pool:
+        outputs, chunk_complete = retrieve_data.retrieve_series([(1000, '20240301')], pool, None, get=True,
+                                                                use_asyncio=use_asyncio)
+    assert sorted(outputs) == (['1.2.3.1', '1.2.3.2'] if status != 0xA702 else [])
+    assert chunk_complete == complete
@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
+import pydicom
+import threading
+
+import anonymize_data
+import benchmark
+from uid_map import UIDMap, UIDTable
+
+N_INSTANCES = 8
+
+
+def test_same_uids_in_every_worker(tmp_path):
+    # The files of one series are anonymized by different worker processes
+    series = benchmark.make_corpus(1, 1, N_INSTANCES)[0]
+    tasks = []
+    for n in range(1, N_INSTANCES + 1):
+        src = str(tmp_path / f'{n}.dcm')
+        benchmark.make_instance(series, n, bytes(16 * 16 * 2)).save_as(src, enforce_file_format=True)
+        tasks.append((src, str(tmp_path / f'{n}.anon.dcm'), '0123456789'))
+    with mp.Pool(4) as pool:
+        results = pool.map(anonymize_data.process_task, tasks, chunksize=1)
+
+    datasets = [pydicom.dcmread(task[1]) for task in tasks]
+    assert {ds.StudyInstanceUID for ds in datasets} == {anonymize_data.UID_MAP.map(series.StudyInstanceUID)}
+    assert {ds.SeriesInstanceUID for ds in datasets} == {anonymize_data.UID_MAP.map(series.SeriesInstanceUID)}
+    assert len({ds.SOPInstanceUID for ds in datasets}) == N_INSTANCES
+    assert all(ds.file_meta.MediaStorageSOPInstanceUID == ds.SOPInstanceUID for ds in datasets)
+
+    # The mappings created by the workers are all returned for the UID table
+    mappings = dict(mapping for _, new_uids, _ in results for mapping in new_uids)
+    assert mappings[series.SeriesInstanceUID] == datasets[0].SeriesInstanceUID
+
+
+def test_mapping_depends_on_salt_and_root():
+    uid = '1.2.3.4'
+    assert UIDMap(salt='a').map(uid) == UIDMap(salt='a').map(uid)
+    assert UIDMap(salt='a').map(uid) != UIDMap(salt='b').map(uid)
+    assert UIDMap(salt='a').map(uid).startswith('2.25.')
+    assert UIDMap(root='1.2.826.0.1.', salt='a').map(uid).startswith('1.2.826.0.1.')
+
+
+def test_drain_returns_each_new_mapping_once():
+    uid_map = UIDMap(salt='a')
+    uid_map.map('1.2.3')
+    uid_map.map('1.2.3')
+    assert uid_map.drain() == [('1.2.3', uid_map.map('1.2.3'))]
+    assert uid_map.drain() == []
+
+
+def test_table_records_conflicts(tmp_path):
+    with UIDTable(str(tmp_path / 'uids.sqlite')) as table:
+        assert table.record([('1.2.3', '2.25.1'), ('1.2.4', '2.25.2')]) == 0
+        assert table.record([('1.2.3', '2.25.9')]) == 1
+        # The first mapping of a UID is kept
+        assert table.original(['2.25.1', '2.25.2', '2.25.9']) == {'2.25.1': '1.2.3', '2.25.2': '1.2.4'}
+
+
+def test_drain_loses_no_mapping_of_other_threads():
+    uid_map = UIDMap(salt='a')
+    drained = []
+    done = threading.Event()
+
+    def drain():
+        while not done.is_set():
+            drained.extend(uid_map.drain())
+
+    drainer = threading.Thread(target=drain)
+    drainer.start()
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(uid_map.map, (f'1.2.3.{i}' for i in range(20000))))
+    done.set()
+    drainer.join()
+    drained += uid_map.drain()
+    assert sorted(drained) == sorted((f'1.2.3.{i}', uid_map.map(f'1.2.3.{i}')) for i in range(20000))
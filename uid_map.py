@@ -0,0 +1,135 @@
+from functools import lru_cache
+import hashlib
+import os
+import sqlite3
+import threading
+import uuid
+from pydicom.uid import generate_uid
+
+# Parameters
+UID_ROOT = None                           # Root of the new UIDs, None for the 2.25 (UUID derived) root
+UID_SALT = os.environ.get('UID_SALT', '')  # Secret mixed into the hash, so that UIDs cannot be mapped back by guessing
+CACHE_SIZE = 65536                        # Number of mapped UIDs kept in memory per process
+
+# UIDs identifying instances, which are remapped in the dataset and all its sequences.
+# Class, transfer syntax and coding scheme UIDs are kept.
+INSTANCE_UIDS = frozenset([
+    'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'MediaStorageSOPInstanceUID',
+    'ReferencedSOPInstanceUID', 'ReferencedSOPInstanceUIDInFile', 'FrameOfReferenceUID',
+    'ReferencedFrameOfReferenceUID', 'RelatedFrameOfReferenceUID', 'SynchronizationFrameOfReferenceUID',
+    'ConcatenationUID', 'DimensionOrganizationUID', 'IrradiationEventUID', 'StorageMediaFileSetUID',
+])
+
+
+class UIDMap:
+    ''' Deterministic mapping of UIDs to hash-derived UIDs.
+
+    The same UID is always mapped to the same new UID for a given root and
+    salt, in every worker process and every run, so that files of a series
+    keep a common series UID without any coordination between workers.
+    Mapped UIDs are kept in an LRU cache, so that the files of a series are
+    only hashed once per worker.
+    Args:
+        root: root of the new UIDs, None for the 2.25 root
+        salt: secret mixed into the hash
+        cache_size: number of mapped UIDs kept in memory
+    '''
+    def __init__(self, root=UID_ROOT, salt=UID_SALT, cache_size=CACHE_SIZE):
+        self.root = root
+        self.salt = salt
+        self.new = []
+        self._warned = False
+        self._lock = threading.Lock()  # The new mappings are shared by the threads using the map, e.g. of receive_data.py
+        self.map = lru_cache(maxsize=cache_size)(self._generate)
+
+    def _generate(self, uid):
+        if not self.salt and not self._warned:
+            # Warned on first use rather than on creation, as anonymize_data.py creates its map on import
+            print('Warning: no UID_SALT set, new UIDs can be recomputed from the original UIDs')
+            self._warned = True
+        if self.root is None:
+            # UUID derived from the hash, as generate_uid ignores the entropy sources for the 2.25 root
+            digest = hashlib.sha512(f'{self.salt}{uid}'.encode()).digest()
+            new_uid = f'2.25.{uuid.UUID(bytes=digest[:16], version=4).int}'
+        else:
+            new_uid = generate_uid(prefix=self.root, entropy_srcs=[self.salt, uid])
+        with self._lock:
+            self.new.append((uid, new_uid))
+        return new_uid
+
+    def remap(self, ds):
+        ''' Remap the instance UIDs of a dataset, its sequences and its file meta information in place.
+        '''
+        datasets = [ds]
+        if hasattr(ds, 'file_meta'):
+            datasets.append(ds.file_meta)
+        for dataset in datasets:
+            for elem in dataset.iterall():
+                if elem.VR != 'UI' or elem.keyword not in INSTANCE_UIDS or not elem.value:
+                    continue
+                if elem.VM > 1:
+                    elem.value = [self.map(str(uid)) for uid in elem.value]
+                else:
+                    elem.value = self.map(str(elem.value))
+
+    def drain(self):
+        ''' Return and forget the mappings created since the last call.
+        '''
+        with self._lock:
+            new, self.new = self.new, []
+        return new
+
+
+class UIDTable:
+    ''' Persistent SQLite table of UID mappings, for tracing anonymized UIDs back.
+    Args:
+        path: SQLite database file
+    '''
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS uids (uid TEXT PRIMARY KEY, new_uid TEXT UNIQUE)')
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def record(self, mappings):
+        ''' Store mappings in one transaction.
+        Return:
+            number of UIDs that were mapped differently before (e.g. with another salt)
+        '''
+        mappings = list(set(mappings))
+        with self._conn:
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS new_uids (uid TEXT, new_uid TEXT)')
+            self._conn.execute('DELETE FROM new_uids')
+            self._conn.executemany('INSERT INTO new_uids VALUES (?, ?)', mappings)
+            conflicts = self._conn.execute(
+                'SELECT COUNT(*) FROM new_uids n JOIN uids u ON n.uid = u.uid WHERE n.new_uid != u.new_uid'
+            ).fetchone()[0]
+            self._conn.execute('INSERT OR IGNORE INTO uids SELECT uid, new_uid FROM new_uids')
+        if conflicts:
+            print(f'Warning: {conflicts} UIDs were mapped differently in a previous run')
+        return conflicts
+
+    def original(self, new_uids):
+        ''' Look up the original UIDs of anonymized UIDs.
+        Return:
+            dict of new UID to original UID
+        '''
+        new_uids = list(new_uids)
+        result = {}
+        for i in range(0, len(new_uids), 500):
+            batch = new_uids[i:i + 500]
+            rows = self._conn.execute(
+                f'SELECT new_uid, uid FROM uids WHERE new_uid IN ({",".join("?" * len(batch))})', batch
+            )
+            result.update(rows)
+        return result
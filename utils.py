@@ -1,15 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+import csv
 import time
 import json
 import os
+import pandas as pd
+import queue
 from pydicom.dataset import Dataset
-from pynetdicom import AE, debug_logger
-from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+from pynetdicom import AE, build_role, debug_logger, evt
+from pynetdicom.sop_class import (
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelMove,
+    EnhancedMRImageStorage,
+    LegacyConvertedEnhancedMRImageStorage,
+    MRImageStorage,
+    MRSpectroscopyStorage,
+    SecondaryCaptureImageStorage,
+)
 import requests
+from requests.adapters import HTTPAdapter
 import shutil
-import subprocess
+import tempfile
+import threading
 import warnings
 import zipfile
+from urllib3.util.retry import Retry
+
+from metrics import METRICS
 
 
 # Parameters
@@ -31,6 +50,22 @@ proxies = {
 }
 AE_TITLE = ""
 AUTH = ('', '')
+CHUNK_SIZE = 1024 * 1024  # Chunk size of streamed downloads and extractions (bytes)
+POOL_SIZE = 4             # Number of keep-alive connections to the archive
+BATCH_SIZE = 50           # Number of series looked up per archive query
+TIMEOUT = (10, 300)       # Connect and read timeout of archive requests (seconds)
+
+# Storage SOP classes accepted when retrieving with C-GET
+STORAGE_CLASSES = [
+    MRImageStorage, EnhancedMRImageStorage, LegacyConvertedEnhancedMRImageStorage,
+    MRSpectroscopyStorage, SecondaryCaptureImageStorage
+]
+SUBOPERATIONS = {
+    'completed': 'NumberOfCompletedSuboperations',
+    'failed': 'NumberOfFailedSuboperations',
+    'warning': 'NumberOfWarningSuboperations',
+    'remaining': 'NumberOfRemainingSuboperations',
+}
 
 
 """
@@ -45,6 +80,33 @@ def calculate_previous_date(date, days=1):
     return previous_date
 
 
+def date_windows(date, days, window=1):
+    ''' Split the days from date backward into windows of consecutive dates.
+    Args:
+        date: first date yyyymmdd
+        days: number of days from date backward
+        window: number of days per window
+    Return:
+        list of (start, end) date pairs, the newest window first
+    '''
+    windows = []
+    for i in range(0, days, window):
+        end = calculate_previous_date(date, days=i)
+        start = calculate_previous_date(date, days=min(i + window, days) - 1)
+        windows.append((start, end))
+    return windows
+
+
+def split_date_range(start, end):
+    ''' Split the date range start-end (yyyymmdd) into two halves.
+    Return:
+        (start, mid) and (mid + 1, end) date pairs
+    '''
+    n_days = (convert_date_format(end) - convert_date_format(start)).days
+    mid = calculate_previous_date(end, days=(n_days + 1) // 2)
+    return (start, mid), (calculate_previous_date(mid, days=-1), end)
+
+
 def convert_date_format(date):
     ''' Convert six-digit date to datetime format.
     '''
@@ -57,23 +119,352 @@ def convert_date_format(date):
 """
     PACS functions
 """
-def retrieve_data(pid, sdate, print_sequences=True, return_response=False):
+class RateLimiter:
+    ''' Limit the number of queries sent to the PACS per second.
+    Args:
+        rate: maximum number of queries per second (0 or None for no limit)
+    '''
+    def __init__(self, rate=0):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        ''' Block until the next query is allowed.
+        '''
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            METRICS.observe('ratelimit_wait_seconds', delay)
+            time.sleep(delay)
+
+
+class PACSSession:
+    ''' Association with the PACS that is reused across queries.
+
+    The association is opened on the first query and kept open for all
+    following queries. It is only re-established when the PACS drops it.
+    Args:
+        ae_title: calling AE title
+        addr: PACS IP address
+        port: PACS port
+        peer_ae_title: called AE title of the PACS
+        contexts: SOP classes requested for the association
+        rate: maximum number of queries per second, or a shared RateLimiter
+        retries: number of reconnection attempts per query
+        cache: QueryCache used to answer C-FINDs without contacting the PACS
+        ext_neg: extended negotiation items, e.g. SCP roles for C-GET
+        evt_handlers: event handlers bound to the association, e.g. for C-STORE
+    '''
+    def __init__(self, ae_title=AE_TITLE, addr=AEC['ip'], port=AEC['port'], peer_ae_title="GEPACS",
+                 contexts=(StudyRootQueryRetrieveInformationModelFind,), rate=0, retries=1, cache=None,
+                 ext_neg=None, evt_handlers=None):
+        self.addr = addr
+        self.port = port
+        self.peer_ae_title = peer_ae_title
+        self.retries = retries
+        self.cache = cache
+        self.ext_neg = ext_neg
+        self.evt_handlers = evt_handlers
+        self.limiter = rate if isinstance(rate, RateLimiter) else RateLimiter(rate)
+        self.ae = AE(ae_title=ae_title)
+        for context in contexts:
+            self.ae.add_requested_context(context)
+        self.assoc = None
+
+        # Statistics
+        self.n_queries = 0
+        self.n_retrieves = 0
+        self.n_associations = 0
+        self.start = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @property
+    def is_established(self):
+        return self.assoc is not None and self.assoc.is_established
+
+    def open(self):
+        ''' Open the association unless it is already established.
+        '''
+        if self.is_established:
+            return True
+        with METRICS.timer('association_open_seconds'):
+            self.assoc = self.ae.associate(self.addr, self.port, ae_title=self.peer_ae_title,
+                                           ext_neg=self.ext_neg, evt_handlers=self.evt_handlers)
+        if self.assoc.is_established:
+            self.n_associations += 1
+            METRICS.count('associations_total')
+            return True
+        METRICS.count('association_failures_total')
+        print("Association rejected, aborted or never connected!")
+        return False
+
+    def abort(self):
+        ''' Abort the association, e.g. from another thread to interrupt a C-MOVE/C-GET.
+        '''
+        assoc = self.assoc
+        if assoc is not None and assoc.is_established:
+            assoc.abort()
+            # A thread waiting for the next response is not woken by the abort, but only
+            # after the DIMSE timeout, so it is handed the empty response of an aborted association
+            assoc.dimse.msg_queue.put((None, None))
+
+    def release(self):
+        ''' Release the association.
+        '''
+        if self.is_established:
+            with METRICS.timer('association_release_seconds'):
+                self.assoc.release()
+        self.assoc = None
+
+    def find(self, ds, model=StudyRootQueryRetrieveInformationModelFind):
+        ''' Send a C-FIND and return the matching identifiers.
+        Args:
+            ds: query dataset
+            model: query/retrieve information model
+        Return:
+            list of identifiers, or None if the query failed, was cancelled or could not be completed
+        '''
+        if self.cache is not None:
+            identifiers = self.cache.get(ds)
+            if identifiers is not None:
+                METRICS.count('cfind_cache_hits_total')
+                return identifiers
+
+        for _ in range(self.retries + 1):
+            if not self.open():
+                continue
+            self.limiter.wait()
+            self.n_queries += 1
+            METRICS.count('cfind_queries_total')
+
+            # Time of every response, from the previous one or from the request
+            identifiers = []
+            status_code = None
+            start = last = time.perf_counter()
+            for status, identifier in self.assoc.send_c_find(ds, model):
+                now = time.perf_counter()
+                METRICS.observe('cfind_response_seconds', now - last)
+                last = now
+                if not status:
+                    # An empty status means the association was aborted or timed out
+                    print("C-FIND Failed")
+                    break
+                if status.Status in (0xFF00, 0xFF01):
+                    if identifier is not None:
+                        identifiers.append(identifier)
+                else:
+                    status_code = status.Status
+
+            METRICS.observe('cfind_query_seconds', last - start)
+            METRICS.count('cfind_responses_total', len(identifiers))
+            if status_code == 0x0000:
+                if self.cache is not None:
+                    self.cache.put(ds, identifiers)
+                return identifiers
+            if status_code is not None:
+                # Failed or cancelled, the partial responses are neither returned nor cached
+                print("C-FIND Query Status: 0x{0:04x}".format(status_code))
+                METRICS.count('cfind_failures_total')
+                return None
+            # Reconnect if the PACS dropped the association
+            self.release()
+        return None
+
+    def retrieve(self, ds, destination=None, model=None, stop=None):
+        ''' Send a C-MOVE to the destination AE, or a C-GET if there is no destination.
+        The progress of the sub-operations is printed from the pending responses.
+        Args:
+            ds: identifier of the study/series to retrieve
+            destination: move destination AE title
+            model: query/retrieve information model
+            stop: threading.Event set to give up the retrieve instead of retrying it, with abort() to interrupt it
+        Return:
+            dict with the final status and the number of completed, failed, warning
+            and remaining sub-operations, or None if the retrieve could not be completed
+        '''
+        for _ in range(self.retries + 1):
+            if stop is not None and stop.is_set():
+                break
+            if not self.open():
+                continue
+            self.limiter.wait()
+            if stop is not None and stop.is_set():
+                break
+            self.n_retrieves += 1
+            operation = 'get' if destination is None else 'move'
+
+            if destination is None:
+                responses = self.assoc.send_c_get(ds, model or StudyRootQueryRetrieveInformationModelGet)
+            else:
+                responses = self.assoc.send_c_move(ds, destination, model or StudyRootQueryRetrieveInformationModelMove)
+
+            # Time of every sub-operation, from the pending responses
+            result = {'status': None, 'completed': 0, 'failed': 0, 'warning': 0, 'remaining': 0}
+            start = last = time.perf_counter()
+            for status, identifier in responses:
+                now = time.perf_counter()
+                METRICS.observe('suboperation_seconds', now - last, operation=operation)
+                last = now
+                if not status:
+                    # An empty status means the association was aborted or timed out
+                    print("C-MOVE/C-GET Failed")
+                    break
+                for key, keyword in SUBOPERATIONS.items():
+                    result[key] = status.get(keyword, result[key])
+                if status.Status == 0xFF00:
+                    print(f"  {result['completed']} completed, {result['failed']} failed, "
+                          f"{result['remaining']} remaining", end='\r')
+                else:
+                    result['status'] = status.Status
+
+            METRICS.observe('retrieve_seconds', last - start, operation=operation)
+            if result['status'] is not None:
+                print(f"  {result['completed']} completed, {result['failed']} failed, "
+                      f"{result['warning']} warning, status 0x{result['status']:04x}")
+                for key in ('completed', 'failed', 'warning'):
+                    METRICS.count(f'suboperations_{key}_total', result[key], operation=operation)
+                return result
+            # Reconnect if the PACS dropped the association
+            self.release()
+        return None
+
+    @property
+    def qps(self):
+        elapsed = time.monotonic() - self.start
+        return self.n_queries / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        print(f'{self.n_queries} queries and {self.n_retrieves} retrieves over {self.n_associations} association(s), '
+              f'{self.qps:.2f} queries/s')
+
+
+def get_session(out_dir=OUT_DIR, **kwargs):
+    ''' Create a session that retrieves series with C-GET and stores them in out_dir.
+    Args:
+        out_dir: output directory of the retrieved instances
+        kwargs: passed to PACSSession
+    '''
+    contexts = [StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelGet] + STORAGE_CLASSES
+    ext_neg = [build_role(uid, scp_role=True) for uid in STORAGE_CLASSES]
+    handlers = [(evt.EVT_C_STORE, store_instance, [out_dir])]
+    return PACSSession(contexts=contexts, ext_neg=ext_neg, evt_handlers=handlers, **kwargs)
+
+
+def store_instance(event, out_dir=OUT_DIR, on_write=None):
+    ''' Handle a C-STORE request by writing the instance to out_dir/<pid>-<date>/<SeriesUID>/.
+    Args:
+        on_write: called with the path of every written file, e.g. to sync the files in batches
+    '''
+    ds = event.dataset
+    pid = str(ds.get('PatientID', ''))
+    pid = str(int(pid)) if pid.isdigit() else pid
+    target_dir = os.path.join(out_dir, f"{pid}-{ds.get('StudyDate', '')}", ds.SeriesInstanceUID)
+    path = os.path.join(target_dir, f'{ds.SOPInstanceUID}.dcm')
+    try:
+        os.makedirs(target_dir, exist_ok=True)
+        data = event.encoded_dataset()
+        with open(path, 'wb', buffering=CHUNK_SIZE) as f:
+            f.write(data)
+        METRICS.count('stored_instances_total')
+        METRICS.count('stored_bytes_total', len(data))
+    except OSError as e:
+        print(f'Storing {ds.SOPInstanceUID} failed: {e}')
+        return 0xA700
+    if on_write is not None:
+        on_write(path)
+    return 0x0000
+
+
+class PACSSessionPool:
+    ''' Bounded pool of PACS sessions shared by worker threads.
+    Args:
+        size: maximum number of concurrent associations with the PACS
+        rate: maximum number of queries per second over all sessions
+        factory: function creating a session, e.g. PACSSession or get_session
+        kwargs: passed to the factory
+    '''
+    def __init__(self, size=1, rate=0, factory=None, **kwargs):
+        factory = factory or PACSSession
+        self.limiter = RateLimiter(rate)
+        self.sessions = [factory(rate=self.limiter, **kwargs) for _ in range(max(1, size))]
+        self._idle = queue.Queue()
+        for session in self.sessions:
+            self._idle.put(session)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @contextmanager
+    def session(self):
+        ''' Borrow an idle session from the pool.
+        '''
+        session = self._idle.get()
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def map(self, func, items, workers=None):
+        ''' Call func(session, item) for all items in parallel.
+        Args:
+            workers: number of parallel calls, one per session if None
+        Return:
+            generator of results in the order of the items
+        '''
+        def call(item):
+            with self.session() as session:
+                return func(session, item)
+
+        workers = min(workers or len(self.sessions), len(self.sessions))
+        if workers == 1:
+            return map(call, items)
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+        def results():
+            with executor:
+                yield from executor.map(call, items)
+        return results()
+
+    def release(self):
+        for session in self.sessions:
+            session.release()
+
+    def report(self):
+        n_queries = sum(session.n_queries for session in self.sessions)
+        n_retrieves = sum(session.n_retrieves for session in self.sessions)
+        n_associations = sum(session.n_associations for session in self.sessions)
+        qps = sum(session.qps for session in self.sessions)
+        print(f'{n_queries} queries and {n_retrieves} retrieves over {n_associations} association(s), '
+              f'{qps:.2f} queries/s')
+
+
+def retrieve_data(pid, sdate, print_sequences=True, return_response=False, session=None, cache=None):
     """ Print all available sequences given patient ID and study date.
     Args:
         pid (str): patient ID
         sdate (str): study date
+        session (PACSSession): open session to query, a new association is used if None
+        cache (QueryCache): cache of C-FIND responses used if no session is given
+    Return:
+        list of series identifiers with return_response, None if the query failed
     """
     patientID = int(pid)
     studyDate = sdate
     identifiers = []
 
-    # Check data by patient ID and study date, and retrieve series ID
-    cmd = f"findscu -S -aet {AET} -k 0008,0052='STUDY' -k 0008,0060='MR' -k 0010,0020={patientID:010d} \
-            -k 0008,0020={studyDate} -k 0010,0030= -aec GEPACS {AEC['ip']} {AEC['port']} 2>&1 | strings | grep 0020,000d"
-    result = subprocess.run([cmd], shell=True, capture_output=True, text=True)
-    if len(result.stdout) > 0:
-        print(result.stdout)
-
     # Retrieve data
     ds = Dataset()
     ds.StudyDate = studyDate            # 0008,0020
@@ -85,171 +476,434 @@ def retrieve_data(pid, sdate, print_sequences=True, return_response=False):
     ds.StudyInstanceUID = ""            # 0020,000d
     ds.SeriesInstanceUID = ""           # 0020,000e
     ds.SeriesDescription = ""           # 0008,103e
+    ds.NumberOfSeriesRelatedInstances = ""  # 0020,1209
+
+    # Use C-FIND to query the PACS, reusing the association of the session if given
+    own_session = session is None
+    if own_session:
+        session = PACSSession(cache=cache)
+    n_queries = session.n_queries
+    responses = session.find(ds)
+    failed = responses is None
+    responses = responses or []
+
+    # Print the study instance UIDs found for the patient and study date
+    study_uids = sorted(set(str(identifier.get('StudyInstanceUID', '')) for identifier in responses))
+    if len(study_uids) > 0:
+        print('Studies:', ', '.join(study_uids))
+
+    for identifier in responses:
+        SerInsUID = identifier.get('SeriesInstanceUID')
+        series_item = identifier.get('SeriesDescription', 'N/A')
+
+        if print_sequences:
+            print(series_item, SerInsUID)
+
+        if return_response:
+            identifiers.append(identifier)
+
+    if own_session:
+        # Release the association and pause for some time if the PACS was queried
+        session.release()
+        if session.n_queries > n_queries:
+            with METRICS.timer('retrieve_pause_seconds'):
+                time.sleep(2)
 
-    # Create association with the PACS server
-    ae = AE(ae_title=AE_TITLE)
-    ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)  # Add the relevant DICOM service UID for query/retrieve
-
-    # Start association with the PACS at IP 172.20.174.148 4100
-    assoc = ae.associate(AEC['ip'], AEC['port'], ae_title=b"GEPACS")
-
-    if assoc.is_established:
-        # Use C-FIND to query the PACS
-        responses = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)  # "P" indicates StudyRootQueryRetrieveInformationModelFind
-
-        for j, (status, identifier) in enumerate(responses):
-            if status:
-                if identifier is not None:
-                    # Check if the study contains brain scans
-                    study_description = identifier.get('StudyDescription', 'N/A')
-                    study_date = identifier.get('StudyDate')
-                    bd = identifier.get('PatientBirthDate')
-                    SerInsUID = identifier.get('SeriesInstanceUID')
-
-                    series_item = identifier.get('SeriesDescription', 'N/A')
+    if return_response:
+        return None if failed else identifiers
 
-                    if print_sequences:
-                        print(series_item, SerInsUID)
 
-                    if return_response:
-                        identifiers.append(identifier)
+def move_data(StuInsUID, SerInsUID, AEM, session=None, stop=None):
+    """ Use C-MOVE to copy data from PACS to a specified AEM
+    Args:
+        StuInsUID:  study instance UID
+        SerInsUID: series instance UID, or list of series instance UIDs of the study
+        AEM: Move destination AE title, the series are retrieved with C-GET if None
+        session: open PACSSession with the C-MOVE/C-GET context, a new association is used if None
+        stop: threading.Event set to give up the move, see PACSSession.retrieve
+    Return:
+        dict with the final status and number of sub-operations, None if the move failed
+    """
+    ds = Dataset()
+    ds.QueryRetrieveLevel = "SERIES"    # 0008,0052
+    ds.StudyInstanceUID = StuInsUID     # 0020,000d
+    ds.SeriesInstanceUID = SerInsUID    # 0020,000e
 
-            else:
-                print("C-FIND Failed")
+    own_session = session is None
+    if own_session:
+        if AEM is None:
+            session = get_session()
+        else:
+            session = PACSSession(contexts=[StudyRootQueryRetrieveInformationModelMove])
+    result = session.retrieve(ds, destination=AEM, stop=stop)
+    if own_session:
+        session.release()
+    return result
 
-        # Release the association
-        assoc.release()
-    else:
-        print("Association rejected, aborted or never connected!")
 
-    # Pause for some time
-    time.sleep(2)
+"""
+    Archive functions
+"""
+class ArchiveClient:
+    ''' Client of the REST API of the archive behind the AEM.
 
-    if return_response:
-        return identifiers
+    Requests share a pool of keep-alive connections and are retried with
+    exponential backoff on 5xx errors and timeouts.
+    Args:
+        url: base URL of the archive
+        auth: (user, password)
+        pool_size: maximum number of open connections
+        retries: maximum number of retries per request
+        backoff: backoff factor between retries (seconds)
+        timeout: (connect, read) timeout of a request (seconds)
+    '''
+    def __init__(self, url=URL, auth=AUTH, pool_size=POOL_SIZE, retries=3, backoff=0.5, timeout=TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+        # Suppress the InsecureRequestWarning
+        warnings.filterwarnings("ignore", category=requests.packages.urllib3.exceptions.InsecureRequestWarning)
+
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.proxies.update(proxies)
+        self.session.verify = False
+        # /tools/find only reads, so POST requests are retried as well
+        # The last 5xx reply is returned instead of raised, so that callers see its status code
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[500, 502, 503, 504], allowed_methods=None,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def find_series(self, SerInsUIDs, patID=None, batch_size=BATCH_SIZE):
+        ''' Look up the archive IDs of many series with a few /tools/find queries.
+        Args:
+            SerInsUIDs: series instance UIDs
+            patID: patient ID of the series, if they all belong to one patient
+            batch_size: number of series instance UIDs per query
+        Return:
+            dict of series instance UID to archive ID
+        '''
+        SerInsUIDs = list(SerInsUIDs)
+        ids = {}
+        for i in range(0, len(SerInsUIDs), batch_size):
+            # Several UIDs separated by backslashes are matched as a list
+            query = {"SeriesInstanceUID" : "\\".join(SerInsUIDs[i:i + batch_size])}
+            if patID is not None:
+                query["PatientID"] = str(patID).zfill(10)
+            data = {"Level" : "Series", "Expand" : True, "Query" : query}
+
+            with METRICS.timer('http_request_seconds', endpoint='find'):
+                response = self.session.post(self.url + '/tools/find', headers=headers, data=json.dumps(data), timeout=self.timeout)
+            if response.status_code != 200:
+                print("Request failed with status code:", response.status_code)
+                print("Response:", response.text)
+                continue
+            for series in response.json() or []:
+                ids[series['MainDicomTags']['SeriesInstanceUID']] = series['ID']
+        return ids
+
+    def download(self, fname, stop=None, timeout=None):
+        ''' Download the archive of a series, streamed in chunks to keep the memory bounded.
+        Args:
+            fname: archive ID of the series
+            stop: threading.Event set to give up the download at the next chunk
+            timeout: (connect, read) timeout of the request, the timeout of the client if None
+        Return:
+            path of the downloaded zip file, None if the download failed or was stopped
+        '''
+        url = f'{self.url}//series/{fname}/archive'
+        start = time.perf_counter()
+        with self.session.get(url, stream=True, timeout=timeout or self.timeout) as response:
+            # Latency until the response headers, then the duration of the whole download
+            METRICS.observe('http_request_seconds', time.perf_counter() - start, endpoint='archive')
+            if response.status_code != 200:
+                print("Download failed with status code:", response.status_code)
+                print("Response:", response.text)  # Print the error message or response content
+                return
+
+            # Save the content to a file, unique per download as the same series may be downloaded in parallel
+            fd, tmp_file = tempfile.mkstemp(prefix=f'{fname}-', suffix='.zip', dir=TMP_DIR)
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if stop is not None and stop.is_set():
+                        break
+                    file.write(chunk)
+                    METRICS.count('http_bytes_total', len(chunk))
+        if stop is not None and stop.is_set():
+            os.remove(tmp_file)
+            print("Download stopped.")
+            return
+        METRICS.observe('http_download_seconds', time.perf_counter() - start)
+        print("Download successful!")
+        return tmp_file
 
 
-def move_data(StuInsUID, SerInsUID, AEM):
-    """ Use MOVESCU to copy data from PACS to a specified AEM
+def download_series(patID, SerInsUID, client=None):
+    """ Find a series in the archive of the AEM and download it as a zip file.
     Args:
-        StuInsUID:  study instance UID
+        patID: patient ID
+        SerInsUID: series instance UID
+        client: ArchiveClient to reuse, a new one is used if None
+    Return:
+        path of the downloaded zip file, None if the download failed
+    """
+    own_client = client is None
+    if own_client:
+        client = ArchiveClient()
+    try:
+        fname = client.find_series([SerInsUID], patID).get(SerInsUID)
+        if fname is None:
+            print("Response is none.")
+            return
+        return client.download(fname)
+    finally:
+        if own_client:
+            client.close()
+
+
+def extract_series(tmp_file, patID, SerInsUID, StuDate):
+    """ Unzip a downloaded series into OUT_DIR/<pid>-<date>/<SeriesUID>/.
+    The dicom files of the archive (<patient>/<study>/<series>/<file>) are
+    written straight to the target directory in a single pass, without
+    intermediate folders. A series already on disk only gets the files it
+    misses.
+    Args:
+        tmp_file: downloaded zip file
+        patID: patient ID
         SerInsUID: series instance UID
-        AEM: Move destination AE title
+        StuDate: study date
     Return:
-        None
+        target directory of the dicom files
     """
-    cmd = f"movescu --debug --port 1234 --max-pdu 64234 -aem {AEM} -S \
-    -k 0008,0052='SERIES' -k 0020,000d='{StuInsUID}' -k 0020,000E='{SerInsUID}' \
-    -aet {AET} -aec GEPACS {AEC['ip']} {AEC['port']}"
-    _ = subprocess.run(cmd, shell=True, capture_output=False, text=True)
+    target_dir = os.path.join(OUT_DIR, f'{patID}-{StuDate}', SerInsUID)
+    start = time.perf_counter()
+    if not os.path.exists(target_dir):
+        # Extract into a temporary folder next to the target, which is renamed once complete
+        os.makedirs(os.path.dirname(target_dir), exist_ok=True)
+        part_dir = tempfile.mkdtemp(prefix=f'{SerInsUID}-', suffix='.part', dir=os.path.dirname(target_dir))
+        unzip_flat(tmp_file, part_dir)
+        try:
+            os.rename(part_dir, target_dir)
+            print(f'Moved {patID}-{StuDate}')
+        except OSError:
+            # The series was extracted in parallel
+            shutil.rmtree(part_dir)
+    else:
+        # Complete a partially retrieved series
+        n_files = unzip_flat(tmp_file, target_dir, skip_existing=True)
+        if n_files:
+            print(f'Completed {patID}-{StuDate}/{SerInsUID} with {n_files} files')
+
+    # Remove file
+    os.remove(tmp_file)
+    METRICS.observe('zip_extract_seconds', time.perf_counter() - start)
+    return target_dir
 
 
-def transfer_data(patID, SerInsUID, StuDate):
+def unzip_flat(zip_file, dest_dir, skip_existing=False):
+    """ Write the files of a zip archive into a directory, without their folders.
+    Return:
+        number of files written
+    """
+    n_files = 0
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            if member.is_dir():
+                continue
+            path = os.path.join(dest_dir, os.path.basename(member.filename))
+            if skip_existing and os.path.exists(path):
+                continue
+            with zip_ref.open(member) as source, open(path, 'wb') as dest:
+                shutil.copyfileobj(source, dest, CHUNK_SIZE)
+            n_files += 1
+            METRICS.count('zip_bytes_total', member.file_size)
+    METRICS.count('zip_files_total', n_files)
+    return n_files
+
+
+def transfer_data(patID, SerInsUID, StuDate, client=None):
     """ Transfer data from the specified AEM to PC.
     Args:
         patID: patient ID
         SerInsUID: series instance UID
         StuDate: study date
+        client: ArchiveClient to reuse, a new one is used if None
     """
-    data = {
-        "Level" : "Series",
-        "Query" : {"PatientID" : str(patID).zfill(10), "SeriesInstanceUID" : SerInsUID}
-    }
-    # Convert data to JSON format
-    data_json = json.dumps(data)
-
-    # Suppress the InsecureRequestWarning
-    warnings.filterwarnings("ignore", category=requests.packages.urllib3.exceptions.InsecureRequestWarning)
-
-    url1 = URL + '/tools/find'
-    response = requests.post(
-        url1,
-        headers=headers,
-        data=data_json,
-        verify=False,
-        auth=AUTH,
-        proxies=proxies
-    )
-
-    # Check response
-    if response.status_code == 200:
-        print("Request successful!")
-        print("Response:", response.json())  # Print the response content
-        if response.json() is not None and len(response.json()) > 0:
-            fname = response.json()[0]
+    tmp_file = download_series(patID, SerInsUID, client=client)
+    if tmp_file is not None:
+        extract_series(tmp_file, patID, SerInsUID, StuDate)
+
+
+"""
+    Pipeline functions
+"""
+def run_pipeline(items, stages, maxsize=8):
+    ''' Run items through stages of worker threads connected by bounded queues.
+
+    Each stage has its own number of workers, so that all stages work at the
+    same time on different items and the throughput is given by the slowest
+    stage. An exception raised for one item is printed and the item dropped.
+    Args:
+        items: iterable of inputs of the first stage
+        stages: list of (name, func, workers), where func(item) returns an
+            iterable of inputs of the next stage (or None)
+        maxsize: capacity of the queues between the stages
+    Return:
+        list of outputs of the last stage
+    '''
+    done = object()
+    queues = [queue.Queue(maxsize) for _ in stages]
+    outputs = []
+    running = [workers for _, _, workers in stages]
+    lock = threading.Lock()
+
+    def feed():
+        for item in items:
+            queues[0].put(item)
+        for _ in range(stages[0][2]):
+            queues[0].put(done)
+
+    def work(i):
+        name, func, _ = stages[i]
+        while True:
+            # Time waiting for an item, and time spent on it including waiting for the next stage
+            with METRICS.timer('pipeline_idle_seconds', stage=name):
+                item = queues[i].get()
+            if item is done:
+                break
+            try:
+                with METRICS.timer('pipeline_item_seconds', stage=name):
+                    for output in func(item) or []:
+                        if i + 1 < len(stages):
+                            queues[i + 1].put(output)
+                        else:
+                            with lock:
+                                outputs.append(output)
+            except Exception as e:
+                print(f'{name} failed for {item}: {e!r}')
+
+        # The last worker of a stage signals the end to the next stage
+        with lock:
+            running[i] -= 1
+            last = running[i] == 0
+        if last and i + 1 < len(stages):
+            for _ in range(stages[i + 1][2]):
+                queues[i + 1].put(done)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for i, (_, _, workers) in enumerate(stages):
+        threads += [threading.Thread(target=work, args=(i,), daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outputs
+
+
+"""
+    Output functions
+"""
+class StreamWriter:
+    ''' Append rows to a CSV or JSONL file batch by batch.
+
+    Every completed batch is recorded in a checkpoint file next to the
+    output, together with the output size at that point. A new writer on the
+    same path resumes after the last completed batch and drops any rows that
+    were written after it. The checkpoint starts with the parameters the rows
+    were produced with, and a run with other parameters starts over.
+    Args:
+        path: output file, the format is given by the extension (.csv or .jsonl)
+        columns: column names
+        dtypes: column types other than str, used when reading the output back
+        resume: continue a previous run instead of starting over
+        params: JSON-serializable parameters the rows depend on, e.g. the query and the batch size
+    '''
+    def __init__(self, path, columns, dtypes=None, resume=True, params=None):
+        self.path = path
+        self.columns = columns
+        self.dtypes = dtypes or {}
+        self.format = os.path.splitext(path)[1].lstrip('.')
+        assert self.format in ['csv', 'jsonl'], print('The output format should be csv or jsonl.')
+        self.checkpoint = path + '.checkpoint'
+        self.done = set()
+        header = json.dumps({'columns': columns, 'params': params}, sort_keys=True)
+
+        size = 0
+        if resume and os.path.exists(self.checkpoint) and os.path.exists(path):
+            with open(self.checkpoint) as f:
+                if f.readline().rstrip('\n') != header:
+                    print(f'{path} was written with other parameters, starting over')
+                else:
+                    for line in f:
+                        key, size = line.rstrip('\n').rsplit('\t', 1)
+                        self.done.add(key)
+            size = int(size)
+        # Drop rows written after the last checkpoint
+        with open(path, 'a') as f:
+            f.truncate(size)
+        if not self.done:
+            with open(self.checkpoint, 'w') as f:
+                f.write(header + '\n')
+
+    def is_done(self, key):
+        return key in self.done
+
+    def write(self, key, rows):
+        ''' Append the rows of a batch and mark the batch as completed.
+        '''
+        with open(self.path, 'a', newline='') as f:
+            if self.format == 'csv':
+                writer = csv.DictWriter(f, fieldnames=self.columns)
+                if f.tell() == 0:
+                    writer.writeheader()
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+
+        with open(self.checkpoint, 'a') as f:
+            f.write(f'{key}\t{size}\n')
+        self.done.add(key)
+
+    def read(self):
+        ''' Read all written rows into a DataFrame.
+        '''
+        if self.format == 'csv':
+            if os.path.getsize(self.path) == 0:
+                df = pd.DataFrame(columns=self.columns, dtype=str)
+            else:
+                df = pd.read_csv(self.path, dtype=str, keep_default_na=False)
         else:
-            print("Response is none.")
-            return
-    else:
-        print("Request failed with status code:", response.status_code)
-        print("Response:", response.text)
-        return
-
-    # 3) Make a GET request (wget) to download file
-    url2 = f'{URL}//series/{fname}/archive'
-    response = requests.get(
-        url2,
-        auth=AUTH,
-        proxies=proxies,
-        verify=False
-    )
-
-    # Check response
-    if response.status_code == 200:
-        # Save the content to a file
-        tmp_file = os.path.join(TMP_DIR, f'{fname}.zip')
-        with open(tmp_file, 'wb') as file:
-            file.write(response.content)
-        print("Download successful!")
-    else:
-        print("Download failed with status code:", response.status_code)
-        print("Response:", response.text)  # Print the error message or response content
-
-    # Unzip the downloaded file
-    tmp_file = os.path.join(TMP_DIR, f'{fname}.zip')
-    with zipfile.ZipFile(tmp_file, 'r') as zip_ref:
-        zip_ref.extractall(os.path.join(TMP_DIR, 'extracted'))  # Extract the contents to a folder
-    #print(os.listdir(os.path.join(TMP_DIR, 'extracted')))
-
-    # 4) Get dcm files
-    extracted_dir = os.path.join(TMP_DIR, 'extracted')
-    top_dir = os.listdir(extracted_dir)[0]
-    dcm_dir = os.path.join(extracted_dir, top_dir)
-    
-    # 5) Rename, remove files
-    # Rename top directory
-    dir_name1 = f'{patID}-{StuDate}'
-    os.rename(dcm_dir, os.path.join(os.path.dirname(dcm_dir), dir_name1))
-    dcm_dir = os.path.join(extracted_dir, dir_name1)
-    
-    # Rename second directory
-    second_dir = os.listdir(dcm_dir)[0]
-    series_dir = os.path.join(dcm_dir, second_dir)
-    dir_name2 = SerInsUID
-    os.rename(series_dir, os.path.join(os.path.dirname(series_dir), dir_name2))
-    series_dir = os.path.join(dcm_dir, dir_name2)
-    print(os.listdir(dcm_dir), os.listdir(os.path.join(dcm_dir, dir_name2)))
-    last_dir = os.listdir(series_dir)[0]
-    dcm_files = os.listdir(os.path.join(series_dir, last_dir))
-
-    Move dcm files to the parent directory
-    print('Moving files')
-    for f in dcm_files:
-        source = os.path.join(series_dir, last_dir, f)
-        dest = os.path.join(series_dir, f)
-        if os.path.isfile(source):
-            shutil.move(source, dest)
-    
-    # Move data to sourcedata directory
-    target_dir = os.path.join(OUT_DIR, dir_name1, dir_name2)
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
-        for f in os.listdir(series_dir):
-            shutil.move(os.path.join(series_dir, f), target_dir)
-    
-        print(f'Moved {dir_name1}')
-    
-    
-    # Remove file
-    shutil.rmtree(dcm_dir)
-    os.remove(tmp_file)
+            df = pd.read_json(self.path, lines=True, dtype=False)
+            df = pd.DataFrame(df, columns=self.columns)
+        return df.astype(self.dtypes)
+
+    def convert(self, fmt, df=None):
+        ''' Convert the output into an Excel (xlsx) or Parquet file.
+        Args:
+            df: rows to write instead of the output, e.g. the output joined with other data
+        Return:
+            path of the converted file
+        '''
+        path = os.path.splitext(self.path)[0] + f'.{fmt}'
+        if df is None:
+            df = self.read()
+        if fmt == 'xlsx':
+            df.to_excel(path)
+        else:
+            df.to_parquet(path)
+        return path